@@ -3,9 +3,18 @@
 
 ###############################################################################
 ## Global libs
+import os
 import sys
+import signal
+import queue
 import socket
-import keyboard
+import selectors
+import functools
+import threading
+from stk_protocol import BATCH_SEP, TRACE_SEP, split_trace
+from latency import LatencyStats, now_ns
+from key_backends import open_backend
+import log
 
 ###############################################################################
 ## Global vars
@@ -15,71 +24,364 @@ BLUE        = '\033[94m'
 YELLOW      = '\033[93m'
 RED         = '\033[91m'
 
-stop        = False
 DEBUG       = False
+# Commands received, logged (asynchronously, see log.py) in debug mode only
+log_command = log.site(log.DEBUG, rate=100)
+log_unknown = log.site(log.DEBUG, rate=100)
+log_failed  = log.site(log.ERROR, rate=1)
 
 address     = ('localhost', 6006)
-sock        = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind(address)
-
-#list of tuples: (received command, keyboard key, keyboard func )
-bindings    = [ ['UP', 'up', keyboard.press_and_release],
-                ['DOWN', 'down', keyboard.press_and_release],
-                ['LEFT', 'left', keyboard.press_and_release],
-                ['RIGHT', 'right', keyboard.press_and_release],
-                ['SELECT', 'enter', keyboard.press_and_release],
-                ['CANCEL', 'backspace', keyboard.press_and_release],
-                ['BACK', 'backspace', keyboard.press_and_release],
-                ['FIRE', 'space', keyboard.press_and_release],
-                ['NITRO', 'n', keyboard.press_and_release],
-                ['P_SKIDDING', 'v', keyboard.press],
-                ['R_SKIDDING', 'v', keyboard.release],
-                ['P_LOOKBACK', 'b', keyboard.press],
-                ['R_LOOKBACK', 'b', keyboard.release],
-                ['RESCUE', 'backspace', keyboard.press_and_release],
-                ['PAUSE', 'escape', keyboard.press_and_release],
-                ['P_UP', 'up', keyboard.press],
-                ['R_UP', 'up', keyboard.release],
-                ['P_DOWN', 'down', keyboard.press],
-                ['R_DOWN', 'down', keyboard.release],
-                ['P_LEFT', 'left', keyboard.press],
-                ['R_LEFT', 'left', keyboard.release],
-                ['P_RIGHT', 'right', keyboard.press],
-                ['R_RIGHT', 'right', keyboard.release],
-                ['P_ACCELERATE', 'up', keyboard.press],
-                ['R_ACCELERATE', 'up', keyboard.release],
-                ['P_BRAKE', 'down', keyboard.press],
-                ['R_BRAKE', 'down', keyboard.release]
+extra_ports = []
+players     = 1     # player N listens on address port + N - 1, see player_bindings
+unix_path   = None
+BACKEND     = 'keyboard'    # key injection, see key_backends.py
+RECV_SIZE   = 1024
+STOP        = b'STOPSERVEUR'
+DUMP        = b'DUMPSTATS'
+
+QUEUE_SIZE  = 256
+OVERFLOW    = 'drop-oldest'
+POLICIES    = ('drop-oldest', 'drop-newest', 'block')
+
+#list of tuples: (received command, keyboard key, keyboard func name)
+bindings    = [ ['UP', 'up', 'press_and_release'],
+                ['DOWN', 'down', 'press_and_release'],
+                ['LEFT', 'left', 'press_and_release'],
+                ['RIGHT', 'right', 'press_and_release'],
+                ['SELECT', 'enter', 'press_and_release'],
+                ['CANCEL', 'backspace', 'press_and_release'],
+                ['BACK', 'backspace', 'press_and_release'],
+                ['FIRE', 'space', 'press_and_release'],
+                ['NITRO', 'n', 'press_and_release'],
+                ['P_SKIDDING', 'v', 'press'],
+                ['R_SKIDDING', 'v', 'release'],
+                ['P_LOOKBACK', 'b', 'press'],
+                ['R_LOOKBACK', 'b', 'release'],
+                ['RESCUE', 'backspace', 'press_and_release'],
+                ['PAUSE', 'escape', 'press_and_release'],
+                ['P_UP', 'up', 'press'],
+                ['R_UP', 'up', 'release'],
+                ['P_DOWN', 'down', 'press'],
+                ['R_DOWN', 'down', 'release'],
+                ['P_LEFT', 'left', 'press'],
+                ['R_LEFT', 'left', 'release'],
+                ['P_RIGHT', 'right', 'press'],
+                ['R_RIGHT', 'right', 'release'],
+                ['P_ACCELERATE', 'up', 'press'],
+                ['R_ACCELERATE', 'up', 'release'],
+                ['P_BRAKE', 'down', 'press'],
+                ['R_BRAKE', 'down', 'release']
+                ]
+
+#keys of the other players, replacing those of player 1 in its bindings (enter
+#and escape stay shared, for the menus). The same keys have to be set for each
+#player in the SuperTuxKart input configuration.
+PLAYER_KEYS = [ {},
+                {'up': 'w', 'down': 's', 'left': 'a', 'right': 'd', 'space': 'q',
+                 'n': 'e', 'v': 'c', 'b': 'x', 'backspace': 'r'},
+                {'up': 'i', 'down': 'k', 'left': 'j', 'right': 'l', 'space': 'u',
+                 'n': 'o', 'v': 'm', 'b': 'p', 'backspace': '0'},
+                {'up': 't', 'down': 'g', 'left': 'f', 'right': 'h', 'space': 'y',
+                 'n': '5', 'v': 'z', 'b': '7', 'backspace': '6'}
                 ]
 
-commands = [b[0] for b in bindings]
+
+def player_bindings(player):
+    """Bindings of player (0 for player 1): the same commands, on its own keys."""
+    keys = PLAYER_KEYS[player]
+    return [[command, keys.get(key, key), func] for command, key, func in bindings]
+
 
 ###############################################################################
-## Main
-if len(sys.argv) > 1:
-    # Reading command line
-    for i in range(1, len(sys.argv)):
-        if sys.argv[i] == '-d':
-            DEBUG = True
-
-print()
-print('STK input server started ', end='')
-if DEBUG:   print(GREEN+'(Debug mode)'+WHITE)
-else:       print()
-
-while (not stop):
-    data, addr = sock.recvfrom(1024)
-    if type(data) is bytes:
-        data = data.decode("utf-8").replace(',','')
-
-    if data == 'STOPSERVEUR':
-        stop = True
-    else:
-        if data in commands:
-            if DEBUG: print(YELLOW+'\t'+data+WHITE)
-            b = bindings[commands.index(data)]
-            b[2](b[1])
+## Dispatch
+def build_dispatch(bindings, backend):
+    """Build the raw datagram -> key action table, once, at startup.
+
+    `backend` provides the keyboard functions named in the bindings (press,
+    release, press_and_release), see key_backends.py. When it has a prepare
+    function, the functions get prepare(key) instead of the key name.
+
+    Every command is registered both as sent by the controller (b'UP') and
+    with the trailing comma OSC-style senders append (b'UP,'), so the hot
+    path is one dict lookup on the received bytes: no decode, no copy, and
+    the cost does not grow with the number of bindings.
+    """
+    table = {}
+    prepare = getattr(backend, 'prepare', None)
+    for command, key, func in bindings:
+        if prepare is not None:
+            key = prepare(key)
+        action  = functools.partial(getattr(backend, func), key)
+        raw     = command.encode('utf-8')
+        table[raw]          = action
+        table[raw + b',']   = action
+    return table
+
+dispatch    = {}    # built by main, see build_dispatch
+
+
+###############################################################################
+## Key injection worker
+class KeyInjector:
+    """Runs key actions on a dedicated thread, fed through a bounded queue.
+
+    The receive loop never calls into the keyboard library itself, so one slow
+    injection cannot stall the sockets. When the queue is full the overflow
+    policy decides what is lost:
+      - 'drop-oldest': discard the oldest queued action (freshest input wins)
+      - 'drop-newest': discard the action being submitted
+      - 'block':       wait for the worker, as the old inline loop did
+    """
+
+    def __init__(self, size=QUEUE_SIZE, policy=OVERFLOW):
+        if policy not in POLICIES:
+            raise ValueError('Unknown overflow policy: {}'.format(policy))
+        self.queue      = queue.Queue(size)
+        self.policy     = policy
+        self.submitted  = 0
+        self.dropped    = 0
+        self.failed     = 0
+        self.max_depth  = 0
+        self.thread     = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, action):
+        self.submitted += 1
+        q = self.queue
+        if self.policy == 'block':
+            q.put(action)
         else:
-            if DEBUG: print(RED+'\t'+data+WHITE+' (Unknown)')
+            try:
+                q.put_nowait(action)
+            except queue.Full:
+                self.dropped += 1
+                if self.policy == 'drop-newest':
+                    return
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                q.put_nowait(action)
+        depth = q.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def run(self):
+        get = self.queue.get
+        while True:
+            action = get()
+            if action is None:
+                break
+            try:
+                action()
+            except Exception as error:
+                # A backend error loses this key event only: the worker goes on
+                self.failed += 1
+                log_failed(RED+'Key injection failed ({} so far): {!r}'+WHITE, self.failed, error)
+
+    def stop(self):
+        """Let the worker finish what is queued, then join it."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        return {'depth':        self.queue.qsize(),
+                'max_depth':    self.max_depth,
+                'submitted':    self.submitted,
+                'dropped':      self.dropped,
+                'failed':       self.failed}
+
+
+###############################################################################
+## Latency tracing
+latency_stats   = LatencyStats()
+
+def traced(action, stamps):
+    """Wrap an action so the worker records the stamps of its command."""
+    def run():
+        inject = now_ns()
+        action()
+        latency_stats.record(stamps + (inject, now_ns()))
+    return run
+
+
+def dump_stats(*args):
+    print(latency_stats.report())
+
+
+###############################################################################
+## Event loop
+def handle(data, injector, stamps=None, table=None):
+    """Queue the action bound to one datagram, in table (the player of the
+    socket it came from, dispatch by default). Returns False on STOPSERVEUR."""
+    if table is None:
+        table = dispatch
+    action = table.get(data)
+    if action is None:
+        if TRACE_SEP in data:
+            try:
+                command, stamps = split_trace(data)
+            except ValueError:
+                # Malformed trace: an unknown command, not a reason to stop
+                if log_unknown.enabled: log_unknown(RED+'\t{}'+WHITE+' (Bad trace)', data.decode('utf-8', 'replace'))
+                return True
+            return handle(command, injector, stamps + (now_ns(),), table)
+        if BATCH_SEP in data:
+            # Several commands in one datagram, applied in order
+            for command in data.split(BATCH_SEP):
+                if not handle(command, injector, stamps, table):
+                    return False
+            return True
+        # Slow path, only for datagrams that are not in the table as is:
+        # the old server stripped every comma, wherever it was.
+        data = data.replace(b',', b'')
+        if data == STOP:
+            return False
+        if data == DUMP:
+            dump_stats()
+            return True
+        action = table.get(data)
+        if action is None:
+            if log_unknown.enabled: log_unknown(RED+'\t{}'+WHITE+' (Unknown)', data.decode('utf-8', 'replace'))
+            return True
+    if log_command.enabled: log_command(YELLOW+'\t{}'+WHITE, data.decode('utf-8', 'replace').rstrip(','))
+    if stamps is not None:
+        action = traced(action, stamps)
+    injector.submit(action)
+    return True
+
+
+def open_listeners(address, extra_ports=(), unix_path=None, players=1):
+    """Bind the default UDP endpoint, one more port per extra player (the
+    following ones), any extra UDP ports and an optional Unix datagram socket.
+    All of them are non-blocking; the first `players` are those of the players,
+    in order."""
+    socks = []
+    ports = [address[1] + player for player in range(players)]
+    for port in ports + list(extra_ports):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((address[0], port))
+        socks.append(sock)
+    if unix_path is not None:
+        if os.path.exists(unix_path):
+            os.unlink(unix_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(unix_path)
+        socks.append(sock)
+    for sock in socks:
+        sock.setblocking(False)
+    return socks
+
+
+def serve(socks, injector, tables=None):
+    """Wait on every listener at once and drain each readable one completely
+    before sleeping again. tables[i] is the dispatch table of socks[i] (of its
+    player), dispatch for the sockets without one."""
+    tables = list(tables or [])
+    tables += [dispatch] * (len(socks) - len(tables))
+    sel = selectors.DefaultSelector()
+    for sock, table in zip(socks, tables):
+        sel.register(sock, selectors.EVENT_READ, table)
+    try:
+        while True:
+            for key, _ in sel.select():
+                recv = key.fileobj.recv
+                table = key.data
+                while True:
+                    try:
+                        data = recv(RECV_SIZE)
+                    except BlockingIOError:
+                        break
+                    except ConnectionResetError:
+                        # Windows reports ICMP port unreachable on UDP sockets
+                        continue
+                    if not handle(data, injector, None, table):
+                        return
+    finally:
+        sel.close()
+
+
+###############################################################################
+## Main
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # Reading command line
+        i = 1
+        while i < len(sys.argv):
+            if sys.argv[i] == '-d':
+                DEBUG = True
+                log.set_level(log.DEBUG)
+            elif sys.argv[i] == '-p':
+                i += 1
+                extra_ports.append(int(sys.argv[i]))
+            elif sys.argv[i] == '-u':
+                i += 1
+                unix_path = sys.argv[i]
+            elif sys.argv[i] == '-q':
+                i += 1
+                QUEUE_SIZE = int(sys.argv[i])
+            elif sys.argv[i] == '-o':
+                i += 1
+                OVERFLOW = sys.argv[i]
+            elif sys.argv[i] == '-n':
+                i += 1
+                players = int(sys.argv[i])
+            elif sys.argv[i] == '-k':
+                i += 1
+                BACKEND = sys.argv[i]
+            i += 1
+    if not 1 <= players <= len(PLAYER_KEYS):
+        print(RED+'From 1 to {} players'.format(len(PLAYER_KEYS))+WHITE)
+        sys.exit(1)
+
+    backend     = None
+    try:
+        backend     = open_backend(BACKEND)
+        # One table per player; extra ports and the Unix socket are player 1's
+        # (build_dispatch raises ValueError for a key the backend cannot type)
+        tables      = [build_dispatch(player_bindings(player), backend) for player in range(players)]
+    except (ImportError, OSError, ValueError) as error:
+        if hasattr(backend, 'close'):
+            backend.close()
+        print(RED+'Cannot use the {} key backend: {}'.format(BACKEND, error)+WHITE)
+        sys.exit(1)
+    dispatch    = tables[0]
+
+    if hasattr(signal, 'SIGUSR1'):
+        # kill -USR1 <pid> prints the latency histograms
+        signal.signal(signal.SIGUSR1, dump_stats)
+
+    socks       = open_listeners(address, extra_ports, unix_path, players)
+    injector    = KeyInjector(QUEUE_SIZE, OVERFLOW)
+    injector.start()
+
+    print()
+    print('STK input server started ', end='')
+    if DEBUG:   print(GREEN+'(Debug mode)'+WHITE, end='')
+    print()
+    for n, sock in enumerate(socks):
+        player = ' (player {})'.format(n + 1) if n < players and players > 1 else ''
+        print(BLUE+'\tlistening on {}{}'.format(sock.getsockname(), player)+WHITE)
+
+    try:
+        serve(socks, injector, tables)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        injector.stop()
+        if hasattr(backend, 'close'):
+            backend.close()
+        for sock in socks:
+            sock.close()
+        if unix_path is not None and os.path.exists(unix_path):
+            os.unlink(unix_path)
 
-print('STK input server stopped')
+    stats = injector.stats()
+    print('STK input server stopped ({submitted} commands, {dropped} dropped, {failed} failed, '
+          'max queue depth {max_depth})'.format(**stats))
+    if hasattr(backend, 'report'):
+        print(backend.report())
+    if latency_stats.histograms['total'].total:
+        dump_stats()
@@ -0,0 +1,94 @@
+"""Time and allocations per frame of the face tracking frame path, before and after
+the preallocated buffers.
+
+usage: python benchmarks/bench_frame_path.py
+
+"before": the camera returns a new array, cv2.flip and cv2.cvtColor allocate the
+detector input, visualize copies it and a second cvtColor converts it back to BGR
+for the display. "after": the camera writes into a FramePool, the detector input
+is converted into a reused buffer without flip, and the preview is flipped and
+annotated in BGR into a reused buffer. The camera read is simulated by a copy of
+a synthetic frame, the detector is left out (it is the same in both paths).
+Allocations are counted with tracemalloc, which sees NumPy buffers.
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import cv2
+import numpy as np
+
+import face_tracking
+from frame_pipeline import FramePool
+from run import synthetic_detection, synthetic_frame
+from types import SimpleNamespace
+
+FRAMES = 300
+
+
+def before(camera, result):
+    img_bgr = camera.copy()  # cap.read() returns a new array
+    img_bgr = cv2.flip(img_bgr, 1)
+    img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+    annotated_image = face_tracking.visualize(img_rgb, result)
+    return cv2.cvtColor(annotated_image, cv2.COLOR_RGB2BGR)
+
+
+def make_after(shape):
+    pool = FramePool(shape, face_tracking.POOL_SIZE)
+    img_rgb = np.empty(shape, np.uint8)
+    display = np.empty(shape, np.uint8)
+
+    def after(camera, result):
+        img_bgr = pool.next()
+        np.copyto(img_bgr, camera)  # cap.read(pool.next()) fills the buffer
+        cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB, dst=img_rgb)
+        return face_tracking.visualize(img_bgr, result, out=display, mirror=True, bgr=True)
+    return after
+
+
+def time_per_frame(path, camera, result):
+    for _ in range(20):
+        path(camera, result)
+    start = time.perf_counter()
+    for _ in range(FRAMES):
+        path(camera, result)
+    return (time.perf_counter() - start) / FRAMES
+
+
+def allocated_per_frame(path, camera, result):
+    """Peak of the memory allocated while processing a frame, averaged over the frames."""
+    tracemalloc.start()
+    total = 0
+    for _ in range(FRAMES):
+        before_frame, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        path(camera, result)
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak - before_frame
+    tracemalloc.stop()
+    return total / FRAMES
+
+
+def main():
+    face_tracking.load_libraries()
+    print('{:<12}{:<8}{:>14}{:>22}'.format('size', 'path', 'ms / frame', 'peak alloc / frame'))
+    for width, height in ((640, 480), (1280, 720)):
+        camera = synthetic_frame(width, height)
+        size = height // 3
+        result = SimpleNamespace(detections=[synthetic_detection(width // 3, height // 4, size, width, height)])
+        after = make_after(camera.shape)
+        for name, path in (('before', before), ('after', after)):
+            per_frame = time_per_frame(path, camera, result)
+            allocated = allocated_per_frame(path, camera, result)
+            print('{:<12}{:<8}{:>14.3f}{:>19.0f} kB'.format(
+                '{}x{}'.format(width, height), name, per_frame * 1e3, allocated / 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Per-tick cost of Controller.update_control, before and after the Axis engine.
+
+usage: python benchmarks/bench_update_control.py
+
+"before" is a copy of the string-dispatched update_control (getattr/setattr on
+'steering_state', 'steering_timer'... and Enum comparisons) that the Axis
+engine replaced; "after" is the current Controller. Both send to a no-op, so
+only the Python work of a tick is measured, in three situations:
+  - idle:  both controls neutral
+  - hold:  both controls active, between two edges
+  - edges: both controls active, an edge due on every tick
+"""
+import math
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from controller import Controller, PWM_PERIOD
+from steering_acceleration import STEER, ACCEL
+
+NUMBER = 200000
+
+
+class LegacyController:
+    """update_control / press_command / release_command as they were."""
+
+    def __init__(self):
+        self.steering_value = 0.0
+        self.steering_direction = STEER.NEUTRAL
+        self.accel_value = 0.0
+        self.accel_direction = ACCEL.NEUTRAL
+
+    def send_data(self, data):
+        pass
+
+    def tick(self, now):
+        return min(self.update_control('steering', self.steering_value, now),
+                   self.update_control('accel', self.accel_value, now))
+
+    def update_control(self, control_type, current_value, now):
+        if control_type == 'steering':
+            direction = self.steering_direction
+            state_attr = 'steering_state'
+            timer_attr = 'steering_timer'
+        elif control_type == 'accel':
+            direction = self.accel_direction
+            state_attr = 'accel_state'
+            timer_attr = 'accel_timer'
+        else:
+            return math.inf
+
+        if not hasattr(self, state_attr):
+            setattr(self, state_attr, None)
+        if not hasattr(self, timer_attr):
+            setattr(self, timer_attr, 0.0)
+
+        pressed = getattr(self, state_attr)
+        timer = getattr(self, timer_attr)
+        next_edge = math.inf
+
+        t1 = current_value * PWM_PERIOD
+        t2 = PWM_PERIOD - t1
+
+        if current_value == 0.0 or direction == STEER.NEUTRAL or direction == ACCEL.NEUTRAL:
+            if pressed is not None:
+                self.release_command(control_type, pressed)
+                pressed = None
+            timer = 0.0
+        elif pressed is not None and pressed != direction:
+            self.release_command(control_type, pressed)
+            self.press_command(control_type, direction)
+            pressed = direction
+            timer = now + t1
+            next_edge = timer
+        elif now < timer:
+            next_edge = timer
+        elif pressed is not None:
+            if t2 <= 0.0:
+                timer = 0.0
+            else:
+                self.release_command(control_type, pressed)
+                pressed = None
+                timer = max(timer + t2, now) if timer else now + t2
+                next_edge = timer
+        else:
+            self.press_command(control_type, direction)
+            pressed = direction
+            timer = max(timer + t1, now) if timer else now + t1
+            next_edge = timer
+
+        setattr(self, state_attr, pressed)
+        setattr(self, timer_attr, timer)
+        return next_edge
+
+    def press_command(self, control_type, direction):
+        if control_type == 'steering':
+            if direction == STEER.LEFT:
+                self.send_data(b'P_LEFT')
+            elif direction == STEER.RIGHT:
+                self.send_data(b'P_RIGHT')
+        elif control_type == 'accel':
+            if direction == ACCEL.UP:
+                self.send_data(b'P_UP')
+            elif direction == ACCEL.DOWN:
+                self.send_data(b'P_DOWN')
+
+    def release_command(self, control_type, direction):
+        if control_type == 'steering':
+            if direction == STEER.LEFT:
+                self.send_data(b'R_LEFT')
+            elif direction == STEER.RIGHT:
+                self.send_data(b'R_RIGHT')
+        elif control_type == 'accel':
+            if direction == ACCEL.UP:
+                self.send_data(b'R_UP')
+            elif direction == ACCEL.DOWN:
+                self.send_data(b'R_DOWN')
+
+
+class NullController(Controller):
+    """The current Controller, without control thread and with a no-op send."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 9), start_loop=False)
+
+    def send_data(self, data):
+        pass
+
+
+def set_inputs(controller, active):
+    steering = STEER.RIGHT if active else STEER.NEUTRAL
+    accel = ACCEL.UP if active else ACCEL.NEUTRAL
+    value = 0.5 if active else 0.0
+    if isinstance(controller, LegacyController):
+        controller.steering_direction, controller.steering_value = steering, value
+        controller.accel_direction, controller.accel_value = accel, value
+    else:
+        controller.steering.direction, controller.steering.value = steering, value
+        controller.accel.direction, controller.accel.value = accel, value
+
+
+def measure(controller, tick, scenario):
+    set_inputs(controller, scenario != 'idle')
+    if scenario == 'hold':
+        tick(0.0)  # press both, next edges are PWM_PERIOD / 2 later
+        times = [0.0] * NUMBER
+    elif scenario == 'edges':
+        # Half a period per tick: every tick is a press or a release
+        times = [(i + 1) * PWM_PERIOD / 2 for i in range(NUMBER)]
+    else:
+        times = [0.0] * NUMBER
+    it = iter(times)
+    elapsed = timeit.timeit(lambda: tick(next(it)), number=NUMBER)
+    return elapsed / NUMBER * 1e9
+
+
+def main():
+    print('{:<8}{:>14}{:>14}{:>10}'.format('tick', 'before (ns)', 'after (ns)', 'speedup'))
+    for scenario in ('idle', 'hold', 'edges'):
+        legacy = LegacyController()
+        before = measure(legacy, legacy.tick, scenario)
+        current = NullController()
+        after = measure(current, current.update_control, scenario)
+        print('{:<8}{:>14.0f}{:>14.0f}{:>9.2f}x'.format(scenario, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+"""Benchmark suite for the hot paths of the project, with stored baselines.
+
+usage: python benchmarks/run.py [-k PATTERN] [--save] [--check] [--tolerance 0.25]
+
+Every benchmark times one operation: the throughput comes from a bulk run, the
+latency percentiles from timing each call on its own (minus the cost of the
+clock). Nothing needs a camera, a phone, the game or root: the Controller
+sends to a no-op, STK_input_server dispatches to a null keyboard backend and
+face_tracking runs on synthetic frames and detections. Benchmarks whose
+dependencies are missing (OpenCV, MediaPipe...) are skipped.
+
+  -k PATTERN       only run the benchmarks whose name contains PATTERN
+  --save           store the results as the new baseline (baseline.json)
+  --check          exit with status 1 if a benchmark is slower than its baseline
+                   by more than the tolerance
+  --tolerance X    allowed throughput loss before --check fails (default 0.25)
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+BULK_TIME = 0.3     # seconds of bulk calls for the throughput
+SAMPLES = 20000     # individually timed calls for the percentiles
+
+benchmarks = []  # (name, function) in run order, see register
+
+
+def register(name):
+    def decorator(setup):
+        benchmarks.append((name, setup))
+        return setup
+    return decorator
+
+
+def cycle(values):
+    """Endless iterator over a list, cheaper than itertools.cycle + next in a lambda."""
+    values = list(values)
+    n = len(values)
+    i = -1
+    def get():
+        nonlocal i
+        i = (i + 1) % n
+        return values[i]
+    return get
+
+
+###############################################################################
+## Controller
+
+def controller_bench(method, values):
+    from bench_update_control import NullController
+    controller = NullController()
+    callback = getattr(controller, method)
+    value = cycle(values)
+    return lambda: callback(value())
+
+# A sweep crossing every threshold, as a finger or the phone moving back and forth
+PAD_SWEEP = [i / 50.0 - 1.0 for i in range(101)] + [1.0 - i / 50.0 for i in range(101)]
+ANGLE_SWEEP = [v * 60.0 for v in PAD_SWEEP]
+ROLL_SWEEP = [-50.0 + v * 40.0 for v in PAD_SWEEP]
+
+@register('controller.callback_x')
+def _():
+    return controller_bench('callback_x', PAD_SWEEP)
+
+@register('controller.callback_y')
+def _():
+    return controller_bench('callback_y', PAD_SWEEP)
+
+@register('controller.callback_yaw')
+def _():
+    return controller_bench('callback_yaw', ANGLE_SWEEP)
+
+@register('controller.callback_roll')
+def _():
+    return controller_bench('callback_roll', ROLL_SWEEP)
+
+@register('controller.callback_yaw_shaker')
+def _():
+    return controller_bench('callback_yaw_shaker', ANGLE_SWEEP)
+
+@register('controller.callback_double_tap')
+def _():
+    return controller_bench('callback_double_tap', [1, 1, 0])
+
+@register('controller.callback_pitch_flick')
+def _():
+    return controller_bench('callback_pitch_flick', ANGLE_SWEEP)
+
+def channel_bench(window):
+    from gestures import Channel
+    channel = Channel(window, threshold=5.0, wrap=360)
+    sample = cycle([(i * 0.01, v) for i, v in enumerate(ANGLE_SWEEP)])
+    offset = [0.0]
+    def run():
+        t, value = sample()
+        if t == 0.0:
+            offset[0] += len(ANGLE_SWEEP) * 0.01
+        channel.add(offset[0] + t, value)
+    return run
+
+# The cost of a sample must not depend on the length of the window
+@register('gestures.Channel.add.window0.1s')
+def _():
+    return channel_bench(0.1)
+
+@register('gestures.Channel.add.window4s')
+def _():
+    return channel_bench(4.0)
+
+@register('controller.update_control.idle')
+def _():
+    from bench_update_control import NullController
+    controller = NullController()
+    return lambda: controller.update_control(0.0)
+
+@register('controller.update_control.edges')
+def _():
+    from bench_update_control import NullController
+    from controller import PWM_PERIOD
+    controller = NullController()
+    controller.callback_x(0.7)
+    controller.callback_y(-0.6)
+    clock = [0.0]
+    def tick():
+        # Half a period per call: most calls send a press or a release
+        clock[0] += PWM_PERIOD / 2
+        controller.update_control(clock[0])
+    return tick
+
+# A hand moving, at each call: its new direction, then the control tick
+HAND_SWEEP = [(0.7 * v, 0.3, 0.7) for v in PAD_SWEEP]
+
+@register('controller.callback_hand_left')
+def _():
+    from bench_update_control import NullController
+    callback = NullController().callback_hand_left
+    direction = cycle(HAND_SWEEP)
+    return lambda: callback(*direction())
+
+@register('controller.update_control.hands')
+def _():
+    from bench_update_control import NullController
+    from controller import PWM_PERIOD
+    controller = NullController()
+    clock = [0.0]
+    controller.clock = lambda: clock[0]
+    direction = cycle(HAND_SWEEP)
+    def tick():
+        clock[0] += PWM_PERIOD / 2
+        controller.callback_hand_left(*direction())
+        controller.callback_hand_right(*direction())
+        controller.update_control(clock[0])
+    return tick
+
+
+###############################################################################
+## STK input server
+
+class InlineInjector:
+    """Runs the actions in the calling thread, to time the dispatch alone."""
+    def submit(self, action):
+        action()
+
+
+def stk_bench(datagrams):
+    import STK_input_server as server
+    from key_backends import NullBackend
+    server.dispatch = server.build_dispatch(server.bindings, NullBackend())
+    injector = InlineInjector()
+    handle = server.handle
+    datagram = cycle(datagrams)
+    return lambda: handle(datagram(), injector)
+
+@register('stk.dispatch')
+def _():
+    return stk_bench([b'P_LEFT', b'R_LEFT', b'P_UP', b'R_UP', b'FIRE'])
+
+@register('stk.dispatch.comma')
+def _():
+    return stk_bench([b'P_LEFT,', b'R_LEFT,', b'P_UP,', b'R_UP,', b'FIRE,'])
+
+@register('stk.dispatch.batch')
+def _():
+    return stk_bench([b'R_LEFT\nP_RIGHT', b'R_UP\nP_DOWN'])
+
+@register('stk.dispatch.unknown')
+def _():
+    return stk_bench([b'NOT_A_COMMAND'])
+
+
+###############################################################################
+## Face tracking
+
+def synthetic_detection(x, y, size, width, height):
+    """Stand-in for a MediaPipe Detection: bounding box in pixels, 6 normalized keypoints."""
+    keypoints = [SimpleNamespace(x=(x + dx * size) / width, y=(y + dy * size) / height)
+                 for dx, dy in ((0.3, 0.35), (0.7, 0.35), (0.5, 0.55), (0.5, 0.75), (0.05, 0.4), (0.95, 0.4))]
+    return SimpleNamespace(
+        bounding_box=SimpleNamespace(origin_x=x, origin_y=y, width=size, height=size),
+        keypoints=keypoints,
+        categories=[SimpleNamespace(category_name=None, score=0.93)])
+
+
+def synthetic_frame(width, height):
+    import numpy as np
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+@register('face._normalized_to_pixel_coordinates')
+def _():
+    import face_tracking
+    convert = face_tracking._normalized_to_pixel_coordinates
+    point = cycle([(0.42, 0.37), (0.0, 1.0), (1.2, -0.1), (0.5, 0.5)])
+    def run():
+        x, y = point()
+        convert(x, y, 640, 480)
+    return run
+
+@register('face.compute3DPos')
+def _():
+    import face_tracking
+    compute = face_tracking.compute3DPos
+    eyes = cycle([(320.0, 240.0, 60.0), (250.0, 200.0, 95.0), (400.0, 300.0, 40.0)])
+    def run():
+        x, y, ipd = eyes()
+        compute(x, y, ipd)
+    return run
+
+def faces_result(width, height, faces):
+    size = height // 3
+    return SimpleNamespace(detections=[
+        synthetic_detection(width // 8 + i * width // 4, height // 4, size, width, height)
+        for i in range(faces)])
+
+def poses_bench(faces):
+    import face_tracking
+    from head_pose import keypoints_array, compute_poses
+    detections = faces_result(640, 480, faces).detections
+    def run():
+        compute_poses(keypoints_array(detections), 640, 480,
+                      face_tracking.user_ipd, face_tracking.fl, mirror=True)
+    return run
+
+@register('face.compute_poses.1face')
+def _():
+    return poses_bench(1)
+
+@register('face.compute_poses.4faces')
+def _():
+    return poses_bench(4)
+
+@register('face.FaceTracker.update.4faces')
+def _():
+    from head_pose import FaceTracker, boxes_array
+    tracker = FaceTracker()
+    boxes = boxes_array(faces_result(640, 480, 4).detections)
+    moves = cycle([boxes + d for d in (0.0, 3.0, 6.0, 3.0)])
+    def run():
+        tracker.update(moves())
+    return run
+
+def visualize_bench(width, height, faces):
+    import face_tracking
+    face_tracking.load_libraries()
+    frame = synthetic_frame(width, height)
+    result = faces_result(width, height, faces)
+    return lambda: face_tracking.visualize(frame, result)
+
+@register('face.visualize.640x480.1face')
+def _():
+    return visualize_bench(640, 480, 1)
+
+@register('face.visualize.640x480.3faces')
+def _():
+    return visualize_bench(640, 480, 3)
+
+@register('face.visualize.1280x720.1face')
+def _():
+    return visualize_bench(1280, 720, 1)
+
+
+###############################################################################
+## Runner
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+
+def measure(operation):
+    clock = time.perf_counter_ns
+
+    # Warm up and size the bulk run
+    start = clock()
+    calls = 0
+    while clock() - start < BULK_TIME * 1e9 / 10:
+        operation()
+        calls += 1
+    calls *= 10
+
+    start = clock()
+    for _ in range(calls):
+        operation()
+    ops_per_s = calls / ((clock() - start) / 1e9)
+
+    overhead = min(-(clock() - clock()) for _ in range(1000))
+    samples = min(SAMPLES, calls)
+    durations = []
+    for _ in range(samples):
+        t0 = clock()
+        operation()
+        durations.append(clock() - t0 - overhead)
+    durations.sort()
+    return {'ops_per_s': round(ops_per_s, 1),
+            'p50_us': round(percentile(durations, 50) / 1e3, 3),
+            'p99_us': round(percentile(durations, 99) / 1e3, 3),
+            'p999_us': round(percentile(durations, 99.9) / 1e3, 3)}
+
+
+def main(argv):
+    pattern = argv[argv.index('-k') + 1] if '-k' in argv else ''
+    tolerance = float(argv[argv.index('--tolerance') + 1]) if '--tolerance' in argv else 0.25
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print('{:<40}{:>14}{:>11}{:>11}{:>11}{:>10}'.format(
+        'benchmark', 'ops/s', 'p50 (us)', 'p99 (us)', 'p99.9 (us)', 'vs base'))
+    for name, setup in benchmarks:
+        if pattern not in name:
+            continue
+        try:
+            operation = setup()
+        except ImportError as e:
+            print('{:<40}skipped ({})'.format(name, e))
+            continue
+        # Callbacks print on every message: keep that out of the terminal
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            result = measure(operation)
+            out.truncate(0)
+        results[name] = result
+
+        delta = ''
+        if name in baseline:
+            ratio = result['ops_per_s'] / baseline[name]['ops_per_s']
+            delta = '{:+.0%}'.format(ratio - 1)
+            if ratio < 1 - tolerance:
+                regressions.append(name)
+                delta += ' !'
+        print('{:<40}{:>14,.0f}{:>11.2f}{:>11.2f}{:>11.2f}{:>10}'.format(
+            name, result['ops_per_s'], result['p50_us'], result['p99_us'], result['p999_us'], delta))
+
+    if '--save' in argv:
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Baseline saved to ' + BASELINE)
+
+    if regressions:
+        print('Slower than baseline by more than {:.0%}: {}'.format(tolerance, ', '.join(regressions)))
+        if '--check' in argv:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
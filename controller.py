@@ -1,166 +1,226 @@
 import socket
 import threading
-from steering_acceleration import STEER, ACCEL
+from steering_acceleration import STEER, ACCEL, STEER_COMMANDS, ACCEL_COMMANDS, Axis
+from stk_protocol import encode_batch, add_trace
+from latency import Tracer
+from gestures import GestureEngine, default_recognizers
+from hands import Hands, LEFT, RIGHT
+import log
 import time
 import math
-last_tap_time = 0
 DOUBLE_TAP_THRESHOLD = 0.5  # Time in seconds between taps to consider it a double tap
 STEER_THRES = 0.4
 ACCEL_THRES = 0.4
 STEER_ANGLE_THRES = 20
 ACCEL_ANGLE_THRES = 15
 ACCEL_ANGLE_OFFSET = -50
+SHAKE_THRESHOLD = 5.0  # Yaw change between two samples to count as a shake swing
+SHAKE_WINDOW = 1.0  # Time window of a shake, in seconds
+SHAKE_COUNT = 3  # Changes of direction of the swings to detect a shake
+FLICK_ANGLE = 30.0  # Pitch change to detect a flick
+FLICK_WINDOW = 0.15  # Time window of a flick, in seconds
+HAND_STEER_ANGLE = 10.0  # Yaw of the hands (degrees) below which they do not steer
+HAND_STEER_FULL = 45.0  # Yaw of the hands for full steering
+HAND_ACCEL_ANGLE = 10.0  # Pitch of the hands (from the offset) below which they do not accelerate / brake
+HAND_ACCEL_FULL = 40.0  # Pitch of the hands for full acceleration / braking
+HAND_ACCEL_OFFSET = 0.0  # Pitch of the hands at rest
+PWM_PERIOD = 1.0 / 60  # Duration of one press + release cycle of the analog controls, in seconds
+COALESCE_TICK = 1.0 / 60  # Minimum time between two applications of coalesced inputs, in seconds
+# Logging call sites (see log.py): sensor values are only logged at the debug
+# level, at most 10 times per second each
+log_values = log.site(log.DEBUG, rate=10)
+log_touch = log.site(log.DEBUG, rate=10)
+log_yaw = log.site(log.DEBUG, rate=10)
+log_event = log.site(log.INFO)
+# Thresholds that a profile can change (see profiles.py)
+PARAMETERS = ('STEER_THRES', 'ACCEL_THRES', 'STEER_ANGLE_THRES', 'ACCEL_ANGLE_THRES',
+              'ACCEL_ANGLE_OFFSET', 'DOUBLE_TAP_THRESHOLD', 'SHAKE_THRESHOLD', 'SHAKE_WINDOW',
+              'SHAKE_COUNT', 'FLICK_ANGLE', 'FLICK_WINDOW', 'HAND_STEER_ANGLE', 'HAND_STEER_FULL',
+              'HAND_ACCEL_ANGLE', 'HAND_ACCEL_FULL', 'HAND_ACCEL_OFFSET')
+
+
+class Parameters:
+    """Thresholds used by the Controller callbacks: the module constants, or the
+    values given (by name, see PARAMETERS)."""
+    __slots__ = PARAMETERS
+
+    def __init__(self, **values):
+        unknown = set(values) - set(PARAMETERS)
+        if unknown:
+            raise ValueError('Unknown parameters: {}'.format(', '.join(sorted(unknown))))
+        for name in PARAMETERS:
+            setattr(self, name, values.get(name, globals()[name]))
+
+
+class LatestSlots:
+    """Fixed table of the latest values received for coalesced OSC addresses.
+
+    A sensor streaming at 100-200 Hz does not need its threshold logic to run
+    for every sample: store keeps only the latest values of each slot (on the
+    OSC thread), and process calls each slot callback once with them (on the
+    control loop, once per tick). The number of samples overwritten before
+    being processed is `received - processed`.
+    """
+
+    def __init__(self, wake):
+        self.wake = wake  # Called when a value arrives in an empty table
+        self.callbacks = []
+        self.values = []  # Latest values per slot, None once processed
+        self.pending = 0  # Slots holding values
+        self.lock = threading.Lock()
+        self.received = 0
+        self.processed = 0
+
+    def add(self, callback):
+        """New slot for callback, returns the function storing its values."""
+        with self.lock:
+            slot = len(self.callbacks)
+            self.callbacks.append(callback)
+            self.values.append(None)
+
+        def store(*values):
+            with self.lock:
+                self.received += 1
+                # Only the store that makes the table non-empty wakes the
+                # control loop, not those overwriting a pending slot
+                first = False
+                if self.values[slot] is None:
+                    self.pending += 1
+                    first = self.pending == 1
+                self.values[slot] = values
+            if first:
+                self.wake()
+        return store
+
+    def discard(self):
+        """Forget the values not processed yet."""
+        with self.lock:
+            self.values = [None] * len(self.callbacks)
+            self.pending = 0
+
+    def clear(self):
+        """Remove all the slots (their store functions must not be called anymore)."""
+        with self.lock:
+            self.callbacks = []
+            self.values = []
+            self.pending = 0
+
+    def process(self):
+        """Call the callbacks of the slots holding values, with the latest ones.
+
+        The lock is held meanwhile, so that once discard or clear returns, no
+        callback runs with values stored before.
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            for slot, values in enumerate(self.values):
+                if values is not None:
+                    self.values[slot] = None
+                    self.processed += 1
+                    self.callbacks[slot](*values)
+            self.pending = 0
+
+    def report(self):
+        return '{} samples received, {} processed, {} coalesced'.format(
+            self.received, self.processed, self.received - self.processed)
+
+
 class Controller:
 
-    def __init__(self, address):
-        self.current_steering = STEER.NEUTRAL
-        self.current_accel = ACCEL.NEUTRAL
+    def __init__(self, address, start_loop=True, batch=False, trace=False, coalesce=False):
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.address = address
-        self.last_tap_time = 0
-        self.tap_count = 0
-        self.shake_threshold = 10  # Adjust this value as needed
-        self.shake_window = 1.0  # Time window to detect shakes
-        self.shake_count_threshold = 3  # Number of shakes required
-        self.accel_history = []
-        self.last_shake_time = 0
-        self.previous_yaw=0.0
-        
-        
-        self.steering_value = 0.0  # Continuous value between 0 and 1 for steering
-        self.steering_direction = STEER.NEUTRAL  # Current steering direction
-
-        self.accel_value = 0.0  # Continuous value between 0 and 1 for acceleration
-        self.accel_direction = ACCEL.NEUTRAL  # Current acceleration direction
+        # In batch mode, commands are queued by send_data and sent together by flush,
+        # once per control loop iteration or callback
+        self.batch = batch
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        # Latency tracing: stamps are added to the commands sent (see latency.py)
+        self.tracer = Tracer() if trace else None
+        # Gestures (shake, double tap, flick, see gestures.py), recognized on
+        # the time of the clock (replaced by the recorded one in replays)
+        self.clock = time.monotonic
+        # Thresholds, replaced as a whole when the profile changes (set_params)
+        self.set_params(Parameters())
+        # Direction of the hands (hand mode), applied by update_control
+        self.hands = Hands()
+
+        # Steering and acceleration state: latest input (direction and continuous
+        # value between 0 and 1), key held and next edge, shared by every mode
+        self.steering = Axis(STEER_COMMANDS, STEER.NEUTRAL, self.send_data, PWM_PERIOD)
+        self.accel = Axis(ACCEL_COMMANDS, ACCEL.NEUTRAL, self.send_data, PWM_PERIOD)
 
         # Control loop variables
-        self.loop_running = True
+        self.loop_running = start_loop
+        self.wakeup = threading.Event()  # Set by the callbacks when an input value changes
+        # Coalescing: the values of high-rate OSC addresses are stored in this
+        # table by OSCServer and applied by the control loop, once per COALESCE_TICK
+        self.slots = LatestSlots(self.wake) if coalesce else None
         self.control_thread = threading.Thread(target=self.control_loop)
-        self.control_thread.start()
+        if start_loop:
+            self.control_thread.start()
 
 
     def send_data(self, data):
         if len(data) > 0:
-            self.client_socket.sendto(data, self.address)
+            if self.batch:
+                with self.pending_lock:
+                    self.pending.append(data)
+            else:
+                if self.tracer is not None:
+                    data = add_trace(data, self.tracer.stamps())
+                self.client_socket.sendto(data, self.address)
+
+    def flush(self):
+        """Send the commands queued by send_data as one datagram (batch mode only)."""
+        if self.pending:
+            with self.pending_lock:
+                data = encode_batch(self.pending)
+                self.pending.clear()
+            if data:
+                if self.tracer is not None:
+                    data = add_trace(data, self.tracer.stamps())
+                self.client_socket.sendto(data, self.address)
 
 
     def callback_x_continuous(self, *values):
-        print("got values for x: {}".format(values))
-        data = b''
+        if log_values.enabled:
+            log_values("got values for x: {}", values)
         acceleration = ACCEL.NEUTRAL
 
-        if values[0] < -STEER_THRES:
+        if values[0] < -self.params.STEER_THRES:
             acceleration = ACCEL.DOWN
-        elif values[0] > STEER_THRES:
+        elif values[0] > self.params.STEER_THRES:
             acceleration = ACCEL.UP
 
-        if self.current_accel != ACCEL.NEUTRAL and acceleration == ACCEL.NEUTRAL:
-            if self.current_accel == ACCEL.UP:
-                data = b'R_UP'
-            elif self.current_accel == ACCEL.DOWN:
-                data = b'R_DOWN'
-
-        if self.current_accel == ACCEL.NEUTRAL and acceleration != ACCEL.NEUTRAL:
-            if acceleration == ACCEL.UP:
-                data = b'P_UP'
-            elif acceleration == ACCEL.DOWN:
-                data = b'P_DOWN'
-
-        self.send_data(data)
-        self.current_accel = acceleration
+        self.accel.set(acceleration)
+        self.flush()
 
     def callback_y_continuous(self, *values):
-        print("got values for y: {}".format(values))
-        data = b''
+        if log_values.enabled:
+            log_values("got values for y: {}", values)
         steering = STEER.NEUTRAL
 
-        if values[0] < -ACCEL_THRES:
+        if values[0] < -self.params.ACCEL_THRES:
             steering = STEER.LEFT
-        elif values[0] > ACCEL_THRES:
+        elif values[0] > self.params.ACCEL_THRES:
             steering = STEER.RIGHT
 
-        if self.current_steering != STEER.NEUTRAL and steering == STEER.NEUTRAL:
-            if self.current_steering == STEER.LEFT:
-                data = b'R_LEFT'
-            elif self.current_steering == STEER.RIGHT:
-                data = b'R_RIGHT'
-
-        if self.current_steering == STEER.NEUTRAL and steering != STEER.NEUTRAL:
-            if steering == STEER.LEFT:
-                data = b'P_LEFT'
-            elif steering == STEER.RIGHT:
-                data = b'P_RIGHT'
-
-        self.send_data(data)
-        self.current_steering = steering
+        self.steering.set(steering)
+        self.flush()
 
     def callback_touchUP_continuous(self, *values):
-        
-        data = b''
-
-        if self.current_accel != ACCEL.NEUTRAL:
-            if self.current_accel == ACCEL.UP:
-                data = b'R_UP'
-            elif self.current_accel == ACCEL.DOWN:
-                data = b'R_DOWN'
-        
-        if self.current_steering != STEER.NEUTRAL:
-            if self.current_steering == STEER.LEFT:
-                data = b'R_LEFT'
-            elif self.current_steering == STEER.RIGHT:
-                data = b'R_RIGHT'
-
-        self.send_data(data)
-     
-     
-     
-        
-    def process_steering(self,steering):
-        
-        
-
-        data = b''
-
-        if self.current_steering != STEER.NEUTRAL and steering == STEER.NEUTRAL:
-            if self.current_steering == STEER.LEFT:
-                data = b'R_LEFT'
-            elif self.current_steering == STEER.RIGHT:
-                data = b'R_RIGHT'
-
-        if self.current_steering == STEER.NEUTRAL and steering != STEER.NEUTRAL:
-            if steering == STEER.LEFT:
-                data = b'P_LEFT'
-            elif steering == STEER.RIGHT:
-                data = b'P_RIGHT'
-
-        if len(data) > 0:
-            self.send_data(data)
-
-        self.current_steering = steering
-
-    def process_acceleration(self,acceleration):
-        data = b''
+        self.discard_coalesced()
+        self.accel.release()
+        self.steering.release()
+        self.flush()
 
-        
-
-        if self.current_accel != ACCEL.NEUTRAL and acceleration == ACCEL.NEUTRAL:
-            if self.current_accel == ACCEL.UP:
-                data = b'R_UP'
-            elif self.current_accel == ACCEL.DOWN:
-                data = b'R_DOWN'
-
-
-
-        if self.current_accel == ACCEL.NEUTRAL and acceleration != ACCEL.NEUTRAL:
-            if acceleration == ACCEL.UP:
-                data = b'P_UP'
-            elif acceleration == ACCEL.DOWN:
-                data = b'P_DOWN'
-
-        if len(data) > 0:
-            self.send_data(data)
+    def process_steering(self, steering):
+        self.steering.set(steering)
 
-        self.current_accel = acceleration
+    def process_acceleration(self, acceleration):
+        self.accel.set(acceleration)
 
 
 
@@ -169,12 +229,13 @@ class Controller:
 
         angle = values[0]
 
-        if angle < - STEER_ANGLE_THRES:
+        if angle < - self.params.STEER_ANGLE_THRES:
             steering = STEER.RIGHT
-        elif angle > STEER_ANGLE_THRES:
+        elif angle > self.params.STEER_ANGLE_THRES:
             steering = STEER.LEFT
 
         self.process_steering(steering)
+        self.flush()
     
     
     def callback_roll(self,*values):
@@ -182,12 +243,13 @@ class Controller:
 
         acceleration = ACCEL.NEUTRAL
 
-        if angle < ACCEL_ANGLE_OFFSET - ACCEL_ANGLE_THRES:
+        if angle < self.params.ACCEL_ANGLE_OFFSET - self.params.ACCEL_ANGLE_THRES:
             acceleration = ACCEL.DOWN
-        elif angle > ACCEL_ANGLE_OFFSET + ACCEL_ANGLE_THRES:
+        elif angle > self.params.ACCEL_ANGLE_OFFSET + self.params.ACCEL_ANGLE_THRES:
             acceleration = ACCEL.UP
 
         self.process_acceleration(acceleration)
+        self.flush()
     
     
     def callback_pitch(*values):
@@ -196,135 +258,78 @@ class Controller:
    
    
     def callback_double_tap(self, *args):
-        print(f"Touch callback called with args: {args}")
-        current_time = time.time()
-        
-        if args and args[0] > 0:  # If touch count is greater than 0
-            if (current_time - self.last_tap_time) < DOUBLE_TAP_THRESHOLD:
-                self.tap_count += 1
-                if self.tap_count == 2:
-                    print("Double tap detected! Sending FIRE command.")
-                    self.send_data(b'FIRE')
-                    self.tap_count = 0
-            else:
-                self.tap_count = 1
-            
-            self.last_tap_time = current_time
-        else:
-            # Reset tap count if touch ended
-            self.tap_count = 0
-  
-    def callback_yaw_shaker(self, *values):
-
-        print("Received yaw values: {}".format(values))
-        data = b''
+        if log_touch.enabled:
+            log_touch("Touch callback called with args: {}", args)
+        # Touch count: a tap is a rise above 0
+        self.gesture('touch', args[0] if args else 0)
 
-        SHAKE_THRESHOLD = 5.0  # You may need to adjust this value based on your sensor's output
+    def callback_yaw_shaker(self, *values):
+        if log_yaw.enabled:
+            log_yaw("Received yaw values: {}", values)
+        self.gesture('yaw', values[0])
 
+    def callback_pitch_flick(self, *values):
+        self.gesture('pitch', values[0])
 
-        current_yaw = values[0]
-        yaw_difference = abs(current_yaw - self.previous_yaw)
+    def gesture(self, channel, value):
+        """Feed a sample to the gesture engine, send the commands of the gestures recognized."""
+        commands = self.gestures.add(channel, value, self.clock())
+        if commands:
+            for command in commands:
+                log_event("Gesture detected on {}! Sending {} command.", channel, command.decode())
+                self.send_data(command)
+            self.flush()
 
-        if yaw_difference > SHAKE_THRESHOLD:
-            data = b'RESCUE'
-            self.send_data(data)
-            print("Shake detected!")
 
-        self.previous_yaw = current_yaw
-        
-        
     def control_loop(self):
-        """Infinite loop running at a target frequency to manage pressed and released commands."""
-        target_frequency = 60  # Loop frequency in Hz (60Hz or adjust to 120Hz if needed)
-        dt = 1.0 / target_frequency  # Time per loop iteration
-        total_cycle_time = dt  # Total time for one cycle (pressed + released)
-
+        """Deadline-driven loop managing pressed and released commands.
+
+        Sleeps until the next press or release edge of either control, or until a
+        callback changes an input value. When both controls are neutral there is
+        no deadline and the thread idles until the next callback. Coalesced
+        values (see LatestSlots) are applied at most once per COALESCE_TICK.
+        """
+        next_tick = 0.0
         while self.loop_running:
-            # Update steering control
-            self.update_control('steering', self.steering_value, total_cycle_time)
-            # Update acceleration control
-            self.update_control('accel', self.accel_value, total_cycle_time)
-            time.sleep(dt)
-
-    def update_control(self, control_type, current_value, total_cycle_time):
-        """Update control states and send commands based on continuous input values."""
-        # Determine the state variables based on control type
-        if control_type == 'steering':
-            direction = self.steering_direction
-            state_attr = 'steering_state'
-            timer_attr = 'steering_timer'
-        elif control_type == 'accel':
-            direction = self.accel_direction
-            state_attr = 'accel_state'
-            timer_attr = 'accel_timer'
-        else:
-            return
+            now = time.monotonic()
+            tick = math.inf
+            if self.slots is not None and self.slots.pending:
+                if now >= next_tick:
+                    self.slots.process()
+                    next_tick = now + COALESCE_TICK
+                else:
+                    tick = next_tick
+            deadline = min(self.update_control(now), tick)
+            self.flush()
 
-        # Initialize state and timer attributes if they don't exist
-        if not hasattr(self, state_attr):
-            setattr(self, state_attr, 'released')
-        if not hasattr(self, timer_attr):
-            setattr(self, timer_attr, 0.0)
+            timeout = None if deadline == math.inf else max(deadline - time.monotonic(), 0.0)
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
 
-        state = getattr(self, state_attr)
-        timer = getattr(self, timer_attr)
+    def wake(self):
+        """Make the control loop re-evaluate the controls immediately."""
+        self.wakeup.set()
 
-        # Calculate t1 and t2 based on current_value
-        t1 = current_value * total_cycle_time
-        t2 = (1 - current_value) * total_cycle_time
+    def update_control(self, now):
+        """Send the press/release edges due at `now` for both controls.
 
-        timer -= total_cycle_time  # Decrement timer
+        Returns the monotonic time of the next edge, or math.inf when nothing has
+        to happen until an input value changes (see Axis.tick).
+        """
+        hands = self.hands
+        if hands.changed or now >= hands.expiry:
+            self.update_hands(now)
+        return min(self.steering.tick(now), self.accel.tick(now), hands.expiry)
 
-        if current_value == 0.0 or direction == STEER.NEUTRAL or direction == ACCEL.NEUTRAL:
-            # Ensure the control is released
-            if state == 'pressed':
-                self.release_command(control_type, direction)
-                state = 'released'
-                timer = 0.0
-        else:
-            if timer <= 0:
-                if state == 'pressed':
-                    self.release_command(control_type, direction)
-                    state = 'released'
-                    timer = t2
-                else:
-                    self.press_command(control_type, direction)
-                    state = 'pressed'
-                    timer = t1
-
-        # Update state and timer attributes
-        setattr(self, state_attr, state)
-        setattr(self, timer_attr, timer)
-
-    def press_command(self, control_type, direction):
-        """Send the 'pressed' command for the given control and direction."""
-        if control_type == 'steering':
-            if direction == STEER.LEFT:
-                self.send_data(b'P_LEFT')
-            elif direction == STEER.RIGHT:
-                self.send_data(b'P_RIGHT')
-        elif control_type == 'accel':
-            if direction == ACCEL.UP:
-                self.send_data(b'P_UP')
-            elif direction == ACCEL.DOWN:
-                self.send_data(b'P_DOWN')
-
-    def release_command(self, control_type, direction):
-        """Send the 'released' command for the given control and direction."""
-        if control_type == 'steering':
-            if direction == STEER.LEFT:
-                self.send_data(b'R_LEFT')
-            elif direction == STEER.RIGHT:
-                self.send_data(b'R_RIGHT')
-            # Reset steering direction if released
-            self.steering_direction = STEER.NEUTRAL
-        elif control_type == 'accel':
-            if direction == ACCEL.UP:
-                self.send_data(b'R_UP')
-            elif direction == ACCEL.DOWN:
-                self.send_data(b'R_DOWN')
-            # Reset acceleration direction if released
-            self.accel_direction = ACCEL.NEUTRAL
+    def update_hands(self, now):
+        """Set both controls from the direction of the hands (see hands.py)."""
+        steer, accel = self.hands.controls(now, self.params)
+        steering = self.steering
+        steering.direction = STEER.RIGHT if steer > 0 else STEER.LEFT if steer < 0 else STEER.NEUTRAL
+        steering.value = abs(steer)
+        acceleration = self.accel
+        acceleration.direction = ACCEL.UP if accel > 0 else ACCEL.DOWN if accel < 0 else ACCEL.NEUTRAL
+        acceleration.value = abs(accel)
 
 
 
@@ -332,44 +337,92 @@ class Controller:
     def callback_x(self, *values):
         """Handle pad x-axis input for steering."""
         x = values[0]
-        self.steering_value = min(abs(x), 1.0)  # Ensure value is between 0 and 1
+        steering = self.steering
 
         # Determine steering direction
-        if x < -STEER_THRES:
-            self.steering_direction = STEER.LEFT
-        elif x > STEER_THRES:
-            self.steering_direction = STEER.RIGHT
+        if x < -self.params.STEER_THRES:
+            steering.direction = STEER.LEFT
+            steering.value = min(-x, 1.0)  # Ensure value is between 0 and 1
+        elif x > self.params.STEER_THRES:
+            steering.direction = STEER.RIGHT
+            steering.value = min(x, 1.0)
         else:
-            self.steering_direction = STEER.NEUTRAL
-            self.steering_value = 0.0  # No steering
+            steering.direction = STEER.NEUTRAL
+            steering.value = 0.0  # No steering
+        self.wake()
 
     def callback_y(self, *values):
         """Handle pad y-axis input for acceleration."""
         y = values[0]
-        self.accel_value = min(abs(y), 1.0)  # Ensure value is between 0 and 1
+        accel = self.accel
 
         # Determine acceleration direction
-        if y < -ACCEL_THRES:
-            self.accel_direction = ACCEL.DOWN  # Brake
-        elif y > ACCEL_THRES:
-            self.accel_direction = ACCEL.UP  # Accelerate
+        if y < -self.params.ACCEL_THRES:
+            accel.direction = ACCEL.DOWN  # Brake
+            accel.value = min(-y, 1.0)  # Ensure value is between 0 and 1
+        elif y > self.params.ACCEL_THRES:
+            accel.direction = ACCEL.UP  # Accelerate
+            accel.value = min(y, 1.0)
         else:
-            self.accel_direction = ACCEL.NEUTRAL
-            self.accel_value = 0.0  # No acceleration
+            accel.direction = ACCEL.NEUTRAL
+            accel.value = 0.0  # No acceleration
+        self.wake()
+
+    # Callback methods for the hand directions (Leap Motion, handtracking.cs):
+    # they only store the vector, update_control computes the controls
+    def callback_hand_left(self, *values):
+        self.hands.store(LEFT, values, self.clock())
+        self.wake()
+
+    def callback_hand_right(self, *values):
+        self.hands.store(RIGHT, values, self.clock())
+        self.wake()
 
     def callback_touchUP(self, *values):
         """Handle touch release event to reset controls."""
+        self.discard_coalesced()
         # Reset steering and acceleration when touch is released
-        self.steering_direction = STEER.NEUTRAL
-        self.steering_value = 0.0
-        self.accel_direction = ACCEL.NEUTRAL
-        self.accel_value = 0.0
-
+        self.steering.direction = STEER.NEUTRAL
+        self.steering.value = 0.0
+        self.accel.direction = ACCEL.NEUTRAL
+        self.accel.value = 0.0
+        self.wake()
+
+
+    def discard_coalesced(self):
+        """Forget the coalesced values not applied yet (touch release).
+
+        They were received before the event, which is not coalesced and runs
+        at once: applied by the next control tick, they would press the keys
+        again. All the coalesced callbacks (see osc_server.COALESCED) set
+        the steering or the acceleration.
+        """
+        if self.slots is not None:
+            self.slots.discard()
+
+    def set_params(self, params):
+        """Use new thresholds, the gestures restart from scratch with them."""
+        self.params = params
+        self.gestures = GestureEngine(default_recognizers(params))
+
+    def release_all(self):
+        """Release every key held and forget the gesture and hand state (profile change)."""
+        self.hands.reset()
+        self.steering.release()
+        self.accel.release()
+        self.gestures.reset()
+        self.flush()
+
+    def stop_loop(self):
+        """Stop the control loop, the socket stays open."""
+        if self.loop_running:
+            self.loop_running = False
+            self.wake()
+            self.control_thread.join()
 
     def stop(self):
         """Stop the control loop and close the socket."""
-        self.loop_running = False
-        self.control_thread.join()
+        self.stop_loop()
         self.client_socket.close()
         
         
@@ -0,0 +1,214 @@
+"""Offline face tracking of recorded footage, on all the cores.
+
+usage:
+  python face_batch.py INPUT... [-o DIR] [-j JOBS] [-f csv|npy] [--chunk N] [--fps N]
+                       [--ipd CM] [--focal PX] [--turn CM] [--near CM] [--far CM] [--no-filter]
+
+INPUT is a video file (BlazeFace in VIDEO mode) or a directory of images, taken
+in name order as the frames of a video (IMAGE mode, at --fps, 30 by default).
+
+The frames are cut into chunks of --chunk frames (300 by default) spread across
+a pool of JOBS processes (all the cores by default), each with its own
+detector. The detections are then gathered in frame order and go through the
+same path as the live tracking (face_tracking.process_result): persistent face
+IDs, pose filter, player selection and HeadControls, with the thresholds given
+on the command line. Nothing is sent: the commands are recorded.
+
+For each INPUT, two tables are written to DIR (current directory by default):
+  NAME.poses.csv|npy     frame, timestamp_ms, face, x, y, z, player
+                         (one row per face and frame, positions in cm)
+  NAME.commands.csv|npy  frame, timestamp_ms, command
+The .npy files hold NumPy structured arrays (np.load(path)).
+"""
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+import face_tracking
+from head_pose import FaceTracker, PoseFilters, keypoints_array, boxes_array, compute_poses
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+POSE_DTYPE = np.dtype([('frame', 'i4'), ('timestamp_ms', 'i8'), ('face', 'i4'),
+                       ('x', 'f8'), ('y', 'f8'), ('z', 'f8'), ('player', '?')])
+COMMAND_DTYPE = np.dtype([('frame', 'i4'), ('timestamp_ms', 'i8'), ('command', 'U16')])
+
+
+def list_frames(path, fps):
+    """(kind, frame count, fps, image paths) of a video file or an image directory."""
+    if os.path.isdir(path):
+        images = sorted(os.path.join(path, name) for name in os.listdir(path)
+                        if name.lower().endswith(IMAGE_EXTENSIONS))
+        return 'images', len(images), fps, images
+    face_tracking.load_opencv()
+    cap = face_tracking.cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError(f"Cannot open {path}")
+    count = int(cap.get(face_tracking.cv2.CAP_PROP_FRAME_COUNT))
+    video_fps = cap.get(face_tracking.cv2.CAP_PROP_FPS) or fps
+    cap.release()
+    return 'video', count, video_fps, None
+
+
+## Worker processes: one detector per process, kept from a chunk to the next.
+## In VIDEO mode the timestamps given to a detector must increase: the pool
+## hands the chunks out in order, so they do for the chunks of one video, and
+## a new detector is created for the next video.
+
+worker_detectors = {}  # kind -> (source, detector)
+
+
+def worker_detector(kind, source):
+    face_tracking.load_libraries()
+    vision = face_tracking.vision
+    current = worker_detectors.get(kind)
+    if current is None or (kind == 'video' and current[0] != source):
+        if current is not None:
+            current[1].close()
+        mode = vision.RunningMode.VIDEO if kind == 'video' else vision.RunningMode.IMAGE
+        current = worker_detectors[kind] = (source, face_tracking.create_detector(mode))
+    return current[1]
+
+
+def detect_chunk(task):
+    """Detect the faces of frames [start, stop) of a video file, or of the
+    image files of source (the paths of frames start to stop).
+
+    Returns a list of (frame, timestamp_ms, width, height, keypoints (N, K, 2),
+    boxes (N, 4)), without the frames that could not be read.
+    """
+    kind, source, start, stop, fps = task
+    # Loads the libraries first: with the spawn and forkserver start methods,
+    # the worker process starts without them
+    detector = worker_detector(kind, source)
+    cv2, mp = face_tracking.cv2, face_tracking.mp
+    if kind == 'video':
+        cap = cv2.VideoCapture(source)
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    rows = []
+    rgb = None
+    for frame in range(start, stop):
+        if kind == 'video':
+            ok, img_bgr = cap.read()
+            if not ok:
+                break
+        else:
+            img_bgr = cv2.imread(source[frame - start])
+            if img_bgr is None:
+                continue
+        if rgb is None or rgb.shape != img_bgr.shape:
+            rgb = np.empty_like(img_bgr)
+        cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB, dst=rgb)
+        image = mp.Image(image_format=mp.ImageFormat.SRGB, data=rgb)
+        timestamp_ms = int(frame * 1000 / fps)
+        if kind == 'video':
+            result = detector.detect_for_video(image, timestamp_ms)
+        else:
+            result = detector.detect(image)
+        height, width = img_bgr.shape[:2]
+        rows.append((frame, timestamp_ms, width, height,
+                     keypoints_array(result.detections), boxes_array(result.detections)))
+    if kind == 'video':
+        cap.release()
+    return rows
+
+
+## Gathering, in frame order
+
+def track(chunks, ipd, focal, controls_options, filtering=True):
+    """Run the detections of all the chunks, in order, through the tracking and
+    controls. Returns the poses and commands tables."""
+    poses_table = []
+    commands_table = []
+    tracker = FaceTracker()
+    filters = PoseFilters(face_tracking.FILTER_MIN_CUTOFF, face_tracking.FILTER_BETA,
+                          horizon_ms=0) if filtering else None
+    current = [0, 0]  # frame, timestamp_ms of the commands being sent
+    controls = face_tracking.HeadControls(
+        send=lambda command: commands_table.append((*current, command)), **controls_options)
+
+    for rows in chunks:
+        for frame, timestamp_ms, width, height, keypoints, boxes in rows:
+            current[:] = frame, timestamp_ms
+            ids = tracker.update(boxes)
+            if not len(ids):
+                if filters is not None:
+                    filters.forget(timestamp_ms)
+                continue
+            poses, valid = compute_poses(keypoints, width, height, ipd, focal, mirror=True)
+            if filters is not None:
+                poses = filters.update(ids, poses, valid, timestamp_ms, timestamp_ms)
+                valid = ~np.isnan(poses[:, 2])
+            player = ids.argmin()
+            for i, face_id in enumerate(ids):
+                if valid[i]:
+                    poses_table.append((frame, timestamp_ms, face_id, *poses[i], i == player))
+            if valid[player]:
+                controls.update(poses[player, 0], poses[player, 2])
+    return np.array(poses_table, POSE_DTYPE), np.array(commands_table, COMMAND_DTYPE)
+
+
+def save(table, path):
+    if path.endswith('.npy'):
+        np.save(path, table)
+    else:
+        formats = {'i': '%d', 'f': '%.3f', 'b': '%d', 'U': '%s'}
+        np.savetxt(path, table, delimiter=',', comments='', header=','.join(table.dtype.names),
+                   fmt=[formats[table.dtype[name].kind] for name in table.dtype.names])
+
+
+def process(paths, out_dir='.', jobs=None, fmt='csv', chunk=300, fps=30.0,
+            ipd=face_tracking.REAL_IPD, focal=face_tracking.fl, filtering=True, **controls_options):
+    face_tracking.load_libraries()
+    with Pool(jobs) as pool:
+        for path in paths:
+            start = time.perf_counter()
+            kind, count, source_fps, images = list_frames(path, fps)
+            tasks = [(kind, images[first:first + chunk] if images else path,
+                      first, min(first + chunk, count), source_fps)
+                     for first in range(0, count, chunk)]
+            poses, commands = track(pool.imap(detect_chunk, tasks), ipd, focal,
+                                    controls_options, filtering)
+            name = os.path.basename(os.path.normpath(path)).rsplit('.', 1)[0]
+            save(poses, os.path.join(out_dir, f"{name}.poses.{fmt}"))
+            save(commands, os.path.join(out_dir, f"{name}.commands.{fmt}"))
+            elapsed = time.perf_counter() - start
+            print(f"{path}: {count} frames in {elapsed:.1f} s ({count / elapsed:.0f} fps), "
+                  f"{len(poses)} poses, {len(commands)} commands")
+
+
+if __name__ == '__main__':
+    paths = []
+    options = {}
+    i = 1
+    while i < len(sys.argv):
+        arg = sys.argv[i]
+        if arg in ('-o', '-j', '-f', '--chunk', '--fps', '--ipd', '--focal', '--turn', '--near', '--far'):
+            i += 1
+            value = sys.argv[i]
+            if arg == '-o':
+                options['out_dir'] = value
+            elif arg == '-j':
+                options['jobs'] = int(value)
+            elif arg == '-f':
+                options['fmt'] = value
+            elif arg == '--chunk':
+                options['chunk'] = int(value)
+            elif arg == '--near':
+                options['accelerate'] = float(value)
+            elif arg == '--far':
+                options['brake'] = float(value)
+            else:
+                options[arg[2:]] = float(value)
+        elif arg == '--no-filter':
+            options['filtering'] = False
+        else:
+            paths.append(arg)
+        i += 1
+    if not paths or options.get('fmt', 'csv') not in ('csv', 'npy'):
+        print(__doc__)
+        sys.exit(1)
+    process(paths, **options)
@@ -11,6 +11,12 @@
 # usage: python tracking.py x                                                        #
 # where x is an optional value to tune the interpupillary distance of the            #
 # tracked subject (by default, the interpupillary distance is set at 6cm).           #
+# options: --headless       no window, stop with Ctrl+C / SIGTERM                    #
+#          --shm NAME       publish the preview in shared memory (preview_viewer.py) #
+#          --preview-fps N  preview refresh rate (default 10)                        #
+#          --no-filter      no pose filtering / latency prediction                   #
+#          --max-age MS     drop the detection results older than MS (default 150)   #
+#          --source SRC     camera index (default 0), video file or "synthetic"      #
 ######################################################################################
 
 # import necessary modules
@@ -18,20 +24,48 @@ import socket
 import sys
 import time
 import math
+import signal
 import threading
 import numpy as np
 from typing import Tuple, Union
 
-# import oscpy for OSC streaming (https://pypi.org/project/ocspy/)
-from oscpy.client import OSCClient
-
-# import opencv for image processing
-import cv2
-
-# import mediapipe for face detection
-import mediapipe as mp
-from mediapipe.tasks import python
-from mediapipe.tasks.python import vision
+from frame_pipeline import LatestValue, ResultRing, FramePool, AdaptiveScale, SharedFrameSlot
+from head_pose import FaceTracker, PoseFilters, keypoints_array, boxes_array, compute_poses
+import log
+
+# opencv (image processing) and mediapipe (face detection) take most of the
+# startup time: they are imported by load_libraries(), when the tracking starts
+# (in the background, see TrackingSession), not with this module. Opening a
+# camera or a video file only needs opencv (load_opencv), not mediapipe
+cv2 = None
+mp = None
+python = None
+vision = None
+opencv_lock = threading.Lock()
+libraries_lock = threading.Lock()
+
+
+def load_opencv():
+    """Import opencv only, once; return the time it took in seconds."""
+    global cv2
+    start = time.perf_counter()
+    with opencv_lock:
+        if cv2 is None:
+            import cv2
+    return time.perf_counter() - start
+
+
+def load_libraries():
+    """Import opencv and mediapipe, once; return the time it took in seconds."""
+    global mp, python, vision
+    start = time.perf_counter()
+    load_opencv()
+    with libraries_lock:
+        if vision is None:
+            import mediapipe as mp
+            from mediapipe.tasks import python
+            from mediapipe.tasks.python import vision
+    return time.perf_counter() - start
 
 
 ########## Part 3: compute the focal length of the webcam ###########
@@ -49,60 +83,140 @@ screen_heigth = 21.6
 # define the default interpupillary distance
 REAL_IPD = 6.3  # Interpupillary distance in cm (average human IPD)
 
-# Set the default interpupillary distance from user input or default
+# Set the default interpupillary distance from user input (in main) or default
 user_ipd = REAL_IPD
 
-if len(sys.argv) >= 2:
-    user_ipd = float(sys.argv[1])
-
-print(f"Tracking initialized with an interpupillary distance of {user_ipd} cm")
-
 
 # define address and port for streaming
 address = "127.0.0.1"
 port = 6006
+sock = None  # UDP socket, created by TrackingSession.start()
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Create a UDP socket
-print("OSC connection established to " + address + " on port " + str(port) + "!")
-
+# camera (or other frame source) and its image size, set by TrackingSession.start()
+cap = None
+frame_width = 640  # Width of the video frame
+frame_height = 480  # Height of the video frame
 
-# capture frames from a camera and the time
-cap = cv2.VideoCapture(0)
-first_time = time.time() * 1000.0
 
-# Get image size
-frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))  # Width of the video frame
-frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))  # Height of the video frame
-print(f"Video size: {frame_width} x {frame_height}")
+################# Part 1: understand how the face dectector works #################
 
 
-################# Part 1: understand how the face dectector works #################
+RESULT_RING_SIZE = 8  # Detection results kept, by frame timestamp
+MAX_RESULT_AGE_MS = 150  # Results older than this when the control stage gets them are dropped
 
 
 # Create a new class for retrieving and storing the tracking results
 class TrackingResults:
-    tracking_results = None
+
+    def __init__(self):
+        # Detection results by frame timestamp, each one taken once by the control stage
+        self.results = ResultRing(RESULT_RING_SIZE, MAX_RESULT_AGE_MS)
+        # timestamp_ms -> (crop (x, y, w, h), scale) of the frames sent as a ROI
+        # or downscaled, until their result arrives (or gets too old, see forget_inputs)
+        self.inputs = {}
+        self.forgotten_ms = -1  # Inputs of the frames before this timestamp were dropped
 
     def get_result(
         self,
-        result: vision.FaceDetectorResult,
-        output_image: mp.Image,
+        result: "vision.FaceDetectorResult",
+        output_image: "mp.Image",
         timestamp_ms: int,
     ):
         # Callback function to store the face detection results
-        self.tracking_results = result
+        detector_input = self.inputs.pop(timestamp_ms, None)
+        if detector_input is not None:
+            map_to_frame(result, *detector_input, frame_width, frame_height)
+        elif timestamp_ms < self.forgotten_ms:
+            return  # Too old, and its input may be gone: it cannot be mapped to the frame
+        self.results.put(timestamp_ms, result)
+
+    def forget_inputs(self, now_ms):
+        """Drop the inputs of the frames older than the maximum result age at
+        now_ms, whose result callbacks never came (or would be dropped)."""
+        limit = now_ms - self.results.max_age_ms
+        self.forgotten_ms = limit
+        for timestamp_ms in [t for t in list(self.inputs) if t < limit]:
+            self.inputs.pop(timestamp_ms, None)
+
+
+# ROI tracking: once faces are found, the detector only gets a padded crop around
+# their last bounding boxes, so the conversion and copy of the detector input scale
+# with the faces and not with the camera resolution (the model itself always works
+# on a 128x128 image, where the faces are then bigger). The whole frame is searched
+# again every FULL_FRAME_INTERVAL frames (for new faces), and as soon as all the
+# faces are lost.
+ROI_TRACKING = True
+ROI_SCALE = 2.0  # Side of the crop around one face, relative to the biggest side of its last bounding box
+ROI_MIN_SIZE = 96  # Smallest crop side, in pixels
+FULL_FRAME_INTERVAL = 30  # Frames between two full-frame searches
+
+
+# Inference resolution: the detector input is downscaled by INFERENCE_SCALE (but
+# never below DETECTOR_INPUT_SIZE, the resolution the model works at). With
+# ADAPTIVE_SCALE, the scale follows the measured time between detect_async and
+# the result callback, to keep it under LATENCY_BUDGET_MS on slower machines.
+# Keypoints are normalized, so they are converted to pixels of the full camera
+# frame whatever the scale, and the IPD-based depth (fl is in full-frame pixels)
+# is not affected.
+INFERENCE_SCALE = 1.0
+ADAPTIVE_SCALE = False
+LATENCY_BUDGET_MS = 25.0
+DETECTOR_INPUT_SIZE = 128
+
+
+def roi_around(boxes, width, height):
+    """Crop (x, y, w, h) around all the (N, 4) bounding boxes, padded so that
+    a single face gives a square of ROI_SCALE times its box, clamped to the frame."""
+    left, top = boxes[:, :2].min(axis=0)
+    right, bottom = (boxes[:, :2] + boxes[:, 2:]).max(axis=0)
+    padding = boxes[:, 2:].max() * (ROI_SCALE - 1)
+    w = min(max(int(right - left + padding), ROI_MIN_SIZE), width)
+    h = min(max(int(bottom - top + padding), ROI_MIN_SIZE), height)
+    x = min(max(int(left + right - w) // 2, 0), width - w)
+    y = min(max(int(top + bottom - h) // 2, 0), height - h)
+    return x, y, w, h
+
+
+def map_to_frame(result, crop, scale, width, height):
+    """Convert, in place, detections found in a crop downscaled by `scale` to
+    full-frame coordinates (the bounding boxes are in pixels of the detector
+    input, the keypoints are normalized to the crop)."""
+    crop_x, crop_y, crop_w, crop_h = crop
+    for detection in result.detections:
+        bbox = detection.bounding_box
+        bbox.origin_x = int(bbox.origin_x / scale) + crop_x
+        bbox.origin_y = int(bbox.origin_y / scale) + crop_y
+        bbox.width = int(bbox.width / scale)
+        bbox.height = int(bbox.height / scale)
+        for keypoint in detection.keypoints:
+            keypoint.x = (keypoint.x * crop_w + crop_x) / width
+            keypoint.y = (keypoint.y * crop_h + crop_y) / height
 
 
 res = TrackingResults()  # Create an instance of TrackingResults
+detector = None  # Face detector, created by TrackingSession
+detector_ready = threading.Event()  # Set once detector is created
+
+
+MODEL_PATH = "blaze_face_short_range.tflite"
+
 
-# Create a face detector instance with the live stream mode:
-base_options = python.BaseOptions(model_asset_path="blaze_face_short_range.tflite")
-options = vision.FaceDetectorOptions(
-    base_options=base_options,
-    running_mode=vision.RunningMode.LIVE_STREAM,
-    result_callback=res.get_result,  # Set the callback function to handle detection results
-)
-detector = vision.FaceDetector.create_from_options(options)  # Create the face detector
+def create_detector(running_mode=None):
+    # Create a face detector instance with the live stream mode (or VIDEO / IMAGE
+    # mode, for recorded footage, see face_batch.py):
+    load_libraries()
+    if running_mode is None:
+        running_mode = vision.RunningMode.LIVE_STREAM
+    base_options = python.BaseOptions(model_asset_path=MODEL_PATH)
+    if running_mode == vision.RunningMode.LIVE_STREAM:
+        options = vision.FaceDetectorOptions(
+            base_options=base_options,
+            running_mode=running_mode,
+            result_callback=res.get_result,  # Set the callback function to handle detection results
+        )
+    else:
+        options = vision.FaceDetectorOptions(base_options=base_options, running_mode=running_mode)
+    return vision.FaceDetector.create_from_options(options)  # Create the face detector
 
 
 #### visualization fonctions ####
@@ -140,32 +254,47 @@ def _normalized_to_pixel_coordinates(
     return x_px, y_px
 
 
-def visualize(image, detection_result) -> np.ndarray:
+def visualize(image, detection_result, out=None, mirror=False, bgr=False) -> np.ndarray:
     """Draws bounding boxes and keypoints on the input image and return it.
     Args:
       image: The input RGB image.
       detection_result: The list of all "Detection" entities to be visualize.
+      out: Optional preallocated array, of the shape of image, to draw into
+        instead of a new copy of image.
+      mirror: Draw the image flipped horizontally, and the detections (found on
+        the unflipped image) mirrored accordingly. The flip replaces the copy.
+      bgr: The image is BGR (straight from OpenCV): the colors are swapped so
+        that the drawing looks the same.
     Returns:
       Image with bounding boxes.
     """
-    annotated_image = image.copy()
+    if mirror:
+        annotated_image = cv2.flip(image, 1, dst=out)
+    elif out is not None:
+        np.copyto(out, image)
+        annotated_image = out
+    else:
+        annotated_image = image.copy()
     height, width, _ = image.shape
 
     if detection_result is None or not detection_result.detections:
       # No detections to visualize; return the original image
       return annotated_image
-    
+
+    text_color = TEXT_COLOR[::-1] if bgr else TEXT_COLOR
+
     for detection in detection_result.detections:
         # Draw bounding_box
         bbox = detection.bounding_box
-        start_point = bbox.origin_x, bbox.origin_y
-        end_point = bbox.origin_x + bbox.width, bbox.origin_y + bbox.height
-        cv2.rectangle(annotated_image, start_point, end_point, TEXT_COLOR, 3)
+        origin_x = width - bbox.origin_x - bbox.width if mirror else bbox.origin_x
+        start_point = origin_x, bbox.origin_y
+        end_point = origin_x + bbox.width, bbox.origin_y + bbox.height
+        cv2.rectangle(annotated_image, start_point, end_point, text_color, 3)
 
         # Draw keypoints
         for keypoint in detection.keypoints:
             keypoint_px = _normalized_to_pixel_coordinates(
-                keypoint.x, keypoint.y, width, height
+                1 - keypoint.x if mirror else keypoint.x, keypoint.y, width, height
             )
             color, thickness, radius = (0, 255, 0), 2, 2
             cv2.circle(annotated_image, keypoint_px, thickness, color, radius)
@@ -179,10 +308,10 @@ def visualize(image, detection_result) -> np.ndarray:
         right_eye = detection.keypoints[0]
         left_eye = detection.keypoints[1]
         right_eye_px = _normalized_to_pixel_coordinates(
-            right_eye.x, right_eye.y, width, height
+            1 - right_eye.x if mirror else right_eye.x, right_eye.y, width, height
         )
         left_eye_px = _normalized_to_pixel_coordinates(
-            left_eye.x, left_eye.y, width, height
+            1 - left_eye.x if mirror else left_eye.x, left_eye.y, width, height
         )
 
         # Draw the eyes with a specific color (green)
@@ -199,7 +328,7 @@ def visualize(image, detection_result) -> np.ndarray:
             int((right_eye_px[0] + left_eye_px[0]) / 2),
             int((right_eye_px[1] + left_eye_px[1]) / 2),
         )
-        center_color = (255, 0, 0)  # Blue color for center
+        center_color = (0, 0, 255) if bgr else (255, 0, 0)  # Blue color for center
         cv2.circle(annotated_image, center_eye_px, radius, center_color, thickness)
 
         # Draw label and score
@@ -208,14 +337,14 @@ def visualize(image, detection_result) -> np.ndarray:
         category_name = "" if category_name is None else category_name
         probability = round(category.score, 2)
         result_text = category_name + " (" + str(probability) + ")"
-        text_location = (MARGIN + bbox.origin_x, MARGIN + ROW_SIZE + bbox.origin_y)
+        text_location = (MARGIN + origin_x, MARGIN + ROW_SIZE + bbox.origin_y)
         cv2.putText(
             annotated_image,
             result_text,
             text_location,
             cv2.FONT_HERSHEY_PLAIN,
             FONT_SIZE,
-            TEXT_COLOR,
+            text_color,
             FONT_THICKNESS,
         )
 
@@ -253,35 +382,298 @@ def compute3DPos(ibe_x, ibe_y, ipd_pixels):
 
 
 ################################ main fonction ##############################
+# Logging call sites (see log.py): the positions are logged at most 10 times
+# per second, not at every frame
+log_command = log.site(log.INFO)
+log_position = log.site(log.INFO, rate=10)
+log_no_face = log.site(log.INFO, rate=1)
+log_read_failed = log.site(log.ERROR)
+
 # Helper function to send UDP commands
 def send_udp_command(command):
     # Send a command via UDP
-    print(f"Sending command: {command}")
+    log_command("Sending command: {}", command)
     sock.sendto(command.encode(), (address, port))
 
-def runtracking():
 
-  print("\nTracking started !!!")
-  print("Hit ESC key to quit...")
-      # Variables to track the previous head state
-  previous_left = False
-  previous_right = False
-  previous_accelerate = False
-  previous_brake = False
-  # infinite loop for processing the video stream
-  while True:
-
-        # add to delay to avoid that the loop run too fast
-        time.sleep(0.05)
-
-        # read one frame from a camera and get the frame timestamp
-        ret, img_bgr = cap.read()
-        frame_timestamp_ms = int(time.time() * 1000 - first_time)
-
-        #! we added on purpose this flip, to remove the mirror effect
-        img_bgr = cv2.flip(img_bgr, 1)
-        # Convert the opencv image to RGB
-        img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+# Head movements mapped to game controls
+TURN_THRESHOLD = 2  # cm from the center, to turn
+ACCELERATE_DISTANCE = 30  # cm from the camera, closer to accelerate
+BRAKE_DISTANCE = 40  # cm from the camera, further to brake
+
+
+class HeadControls:
+    # Variables to track the previous head state
+    def __init__(self, send=None, turn=TURN_THRESHOLD, accelerate=ACCELERATE_DISTANCE, brake=BRAKE_DISTANCE):
+        # send(command): send_udp_command by default
+        self.send = send if send is not None else send_udp_command
+        self.turn = turn
+        self.accelerate = accelerate
+        self.brake = brake
+        self.previous_left = False
+        self.previous_right = False
+        self.previous_accelerate = False
+        self.previous_brake = False
+
+    def update(self, pos_x, pos_z):
+        if pos_x > self.turn:  # Turn right
+            if not self.previous_right:
+                self.send("P_RIGHT")  # Press right
+                self.previous_right = True
+            if self.previous_left:  # Release left if previously pressed
+                self.send("R_LEFT")
+                self.previous_left = False
+        elif pos_x < -self.turn:  # Turn left
+            if not self.previous_left:
+                self.send("P_LEFT")  # Press left
+                self.previous_left = True
+            if self.previous_right:  # Release right if previously pressed
+                self.send("R_RIGHT")
+                self.previous_right = False
+        else:  # Head is centered, release both left and right
+            if self.previous_left:
+                self.send("R_LEFT")
+                self.previous_left = False
+            if self.previous_right:
+                self.send("R_RIGHT")
+                self.previous_right = False
+
+        if pos_z < self.accelerate:  # Accelerate (close to the camera)
+            if not self.previous_accelerate:
+                self.send("P_ACCELERATE")
+                self.previous_accelerate = True
+        elif pos_z > self.brake:  # Brake (far from the camera)
+            if not self.previous_brake:
+                self.send("P_BRAKE")
+                self.previous_brake = True
+            if self.previous_accelerate:  # Release accelerate
+                self.send("R_ACCELERATE")
+                self.previous_accelerate = False
+        else:  # Neither brake nor accelerate
+            if self.previous_brake:
+                self.send("R_BRAKE")
+                self.previous_brake = False
+            if self.previous_accelerate:
+                self.send("R_ACCELERATE")
+                self.previous_accelerate = False
+
+
+# Pose filtering: the positions are smoothed by a One-Euro filter per face (less
+# jitter around the thresholds of HeadControls, so no press/release chatter), and
+# predicted from the capture time of the frame to the current time, at constant
+# velocity, to compensate for the detection latency (at most PREDICTION_HORIZON_MS).
+POSE_FILTERING = True
+FILTER_MIN_CUTOFF = 1.0  # Hz, cutoff when the head does not move
+FILTER_BETA = 0.05  # Cutoff increase per cm/s of head speed
+PREDICTION_HORIZON_MS = 100
+
+
+def process_result(timestamp_ms, result, controls, tracker, filters=None):
+    """Control stage: compute the 3D position of every face of one detection
+    result (frame captured at timestamp_ms), in one vectorized call, and map the
+    player's face to game commands.
+
+    The player is the face tracked for the longest time (the smallest ID), so
+    that another face entering the image does not take the controls. With
+    filters (PoseFilters), the positions are filtered and predicted at the
+    current time before the thresholds are applied.
+    """
+    if result and result.detections:
+        #### Part 2: get the position of the eyes and compute the center of the eyes ####
+        # (the detector gets the unflipped camera image: the mirror flip is
+        # applied here, to the x coordinates)
+        ids = tracker.update(boxes_array(result.detections))
+
+        ###################### Part 4: compute the 3D position ###########################
+        poses, valid = compute_poses(
+            keypoints_array(result.detections), frame_width, frame_height,
+            user_ipd, fl, mirror=True,
+        )
+        if filters is not None:
+            poses = filters.update(ids, poses, valid, timestamp_ms, time.monotonic() * 1000)
+            valid = ~np.isnan(poses[:, 2])
+        if log_position.enabled:
+            for face_id, (pos_x, pos_y, pos_z), ok in zip(ids, poses, valid):
+                if ok:
+                    log_position("Face {} 3D position: {:.2f} - {:.2f} - {:.2f}", face_id, pos_x, pos_y, pos_z)
+                else:
+                    log_position("Face {}: invalid interpupillary distance.", face_id)
+
+        player = ids.argmin()
+        if valid[player]:
+            controls.update(poses[player, 0], poses[player, 2])
+    else:
+        tracker.update(np.empty((0, 4)))
+        if filters is not None:
+            filters.forget(timestamp_ms)
+        log_no_face("No face detected.")
+
+
+# The tracking runs as stages connected by a latest-value buffer (frames) and a
+# ring of results keyed by frame timestamp, so that none of them waits for
+# another one and the head-to-command latency only depends on the camera and the
+# detector:
+#   capture thread   reads the camera, always holds the freshest frame
+#   inference thread sends the freshest frame to the detector as soon as the
+#                    previous one has been processed
+#   control thread   maps each detection result to game commands, exactly once,
+#                    dropping the results older than MAX_RESULT_AGE_MS
+#   preview          draws the latest frame and its result (or the last result
+#                    available, if it is not there yet) at PREVIEW_FPS, in the
+#                    window (main thread) and/or a shared-memory slot, or not at
+#                    all in headless mode
+#
+# No stage allocates per frame: the camera writes into a FramePool, the detector
+# input is converted into one reused RGB buffer and the preview is flipped and
+# annotated in BGR into one reused display buffer. The mirror flip is not applied
+# to the detector input, only to the coordinates and to the preview.
+
+PREVIEW_FPS = 10  # Refresh rate of the preview (window or shared memory)
+RESULT_TIMEOUT = 0.5  # Max time to wait for the detector before sending the next frame
+POOL_SIZE = 4  # Camera frames in flight: a stage must copy a frame out within 3 frame periods
+READ_RETRY_DELAY = 0.05  # Wait after a failed read of the source, in seconds
+MAX_READ_FAILURES = 100  # Consecutive failed reads (5 s) after which the tracking stops
+
+
+# Frame sources other than the camera, with the cap.read(image) interface of
+# cv2.VideoCapture, to run without a camera
+
+class SyntheticSource:
+    """Frames of a moving gradient at `fps`, made with NumPy only (no opencv, no
+    device): the tracking starts in milliseconds, for dry runs and benchmarks."""
+
+    def __init__(self, width=640, height=480, fps=30.0):
+        self.width = width
+        self.height = height
+        self.period = 1.0 / fps
+        ramp = np.arange(width * 2, dtype=np.uint16) % 256
+        self.pattern = np.broadcast_to(ramp.astype(np.uint8)[None, :, None], (height, width * 2, 3))
+        self.next_frame = time.monotonic()
+        self.index = 0
+
+    def read(self, image=None):
+        self.next_frame = max(self.next_frame + self.period, time.monotonic())
+        time.sleep(max(0.0, self.next_frame - time.monotonic()))
+        self.index = (self.index + 4) % self.width
+        frame = self.pattern[:, self.index:self.index + self.width]
+        if image is None:
+            return True, frame.copy()
+        np.copyto(image, frame)
+        return True, image
+
+    def release(self):
+        pass
+
+
+class VideoFileSource:
+    """A video file played at its frame rate, in a loop, as if it was a camera."""
+
+    def __init__(self, path):
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise IOError(f"Cannot open {path}")
+        self.width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.period = 1.0 / (self.capture.get(cv2.CAP_PROP_FPS) or 30.0)
+        self.next_frame = time.monotonic()
+
+    def read(self, image=None):
+        self.next_frame = max(self.next_frame + self.period, time.monotonic())
+        time.sleep(max(0.0, self.next_frame - time.monotonic()))
+        ret, image = self.capture.read(image)
+        if not ret:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, image = self.capture.read(image)
+        return ret, image
+
+    def release(self):
+        self.capture.release()
+
+
+def open_source(source):
+    """Frame source and its image size, for a camera index, a video file or "synthetic"."""
+    if source == "synthetic":
+        synthetic = SyntheticSource()
+        return synthetic, synthetic.width, synthetic.height
+    load_opencv()
+    if isinstance(source, int) or source.isdigit():
+        camera = cv2.VideoCapture(int(source))
+        if not camera.isOpened():
+            raise IOError(f"Cannot open camera {source}")
+        return camera, int(camera.get(cv2.CAP_PROP_FRAME_WIDTH)), int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    video = VideoFileSource(source)
+    return video, video.width, video.height
+
+
+def capture_stage(frames, stop):
+    pool = FramePool((frame_height, frame_width, 3), POOL_SIZE)
+    last_timestamp_ms = -1
+    failures = 0
+    while not stop.is_set():
+        # read one frame from a camera, into the next buffer of the pool, and get the frame timestamp
+        ret, img_bgr = cap.read(pool.next())
+        if not ret:
+            # A disconnected camera fails at once: do not spin on it
+            failures += 1
+            if failures >= MAX_READ_FAILURES:
+                log_read_failed("Cannot read frames from the source anymore, stopping.")
+                stop.set()
+            stop.wait(READ_RETRY_DELAY)
+            continue
+        failures = 0
+        # The timestamp identifies the frame (and its detection result): it
+        # must be unique, and strictly increasing for the detector
+        timestamp_ms = max(int(time.monotonic() * 1000), last_timestamp_ms + 1)
+        last_timestamp_ms = timestamp_ms
+        frames.put((timestamp_ms, img_bgr))
+
+
+def inference_stage(frames, stop):
+    frame_seq = 0
+    # Backing memory of the detector input (downscaled BGR, RGB), reused for
+    # every frame and crop size through contiguous views
+    small_buffer = np.empty(0, np.uint8)
+    rgb_buffer = np.empty(0, np.uint8)
+    roi = None  # Crop (x, y, w, h) around the tracked face, None for a full-frame search
+    since_full_frame = 0
+    scale = AdaptiveScale(INFERENCE_SCALE, LATENCY_BUDGET_MS, ADAPTIVE_SCALE)
+    # The detector may still be loading in the background: drop the frames until then
+    while not detector_ready.wait(0.1):
+        if stop.is_set():
+            return
+    while not stop.is_set():
+        frame_seq, frame = frames.get(frame_seq, timeout=0.1)
+        if frame is None:
+            continue
+        timestamp_ms, img_bgr = frame
+
+        if roi is not None and since_full_frame < FULL_FRAME_INTERVAL:
+            x, y, w, h = roi
+            img_bgr = img_bgr[y:y + h, x:x + w]
+            crop = roi
+            since_full_frame += 1
+        else:
+            crop = (0, 0, frame_width, frame_height)
+            since_full_frame = 0
+
+        # Downscale, but not below the resolution of the model
+        height, width = img_bgr.shape[:2]
+        factor = min(max(scale.value, DETECTOR_INPUT_SIZE / min(width, height)), 1.0)
+        if factor < 1.0:
+            size = (max(1, round(width * factor)), max(1, round(height * factor)))
+            if small_buffer.size < size[0] * size[1] * 3:
+                small_buffer = np.empty(size[0] * size[1] * 3, np.uint8)
+            small = small_buffer[:size[0] * size[1] * 3].reshape(size[1], size[0], 3)
+            img_bgr = cv2.resize(img_bgr, size, dst=small, interpolation=cv2.INTER_AREA)
+            factor = size[0] / width
+        if crop[2:] != (frame_width, frame_height) or factor != 1.0:
+            res.inputs[timestamp_ms] = (crop, factor)
+
+        # Convert the opencv image to RGB, in the reused buffer
+        if rgb_buffer.size < img_bgr.size:
+            rgb_buffer = np.empty(img_bgr.size, np.uint8)
+        img_rgb = rgb_buffer[:img_bgr.size].reshape(img_bgr.shape)
+        cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB, dst=img_rgb)
 
         # Convert the frame received from OpenCV to a MediaPipe’s Image object.
         mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=img_rgb)
@@ -289,121 +681,226 @@ def runtracking():
         # Send live image data to perform face detection.
         # The results are accessible via the `result_callback` provided in
         # the `FaceDetectorOptions` object.
-        # The face detector must be created with the live stream mode.
-        detector.detect_async(
-            mp_image, int(time.time() * 1000)
-        )  # Perform asynchronous face detection
-
-        if res.tracking_results and res.tracking_results.detections:
-            #### Part 2: get the position of the eyes and compute the center of the eyes ####
-
-            # If a face is detected
-            # Get the biggest face
-            # TODO....
-            biggest_face = max(
-                res.tracking_results.detections,
-                key=lambda d: d.bounding_box.width * d.bounding_box.height,
-            )
-            # Get the position of the two eyes in pixels
-            # TODO....
-            right_eye = biggest_face.keypoints[0]  # Get right eye keypoint
-            left_eye = biggest_face.keypoints[1]  # Get left eye keypoint
-            # If we have a position for the two eyes
-            # compute the position between the two eyes (in pixels)
-            # TODO....
-            right_eye_px = _normalized_to_pixel_coordinates(
-                right_eye.x, right_eye.y, frame_width, frame_height
-            )
-            left_eye_px = _normalized_to_pixel_coordinates(
-                left_eye.x, left_eye.y, frame_width, frame_height
-            )
-            # compute the interpupillary distance (in pixels)
-            # TODO....
-            if right_eye_px and left_eye_px:
-                ipd_pixels = math.hypot(
-                    right_eye_px[0] - left_eye_px[0], right_eye_px[1] - left_eye_px[1]
-                )
-            ###################### Part 4: compute the 3D position ###########################
-            # compute the 3D position in the reference frame of the screen center
-            # pos_x, pos_y, pos_z =
-            # TODO...
-            if right_eye_px and left_eye_px:
-                ibe_x = (right_eye_px[0] + left_eye_px[0]) / 2
-                ibe_y = (right_eye_px[1] + left_eye_px[1]) / 2
-
-            ################### Part 5: send the head position with OSC ######################
-            # clientOSC.send_message(b'/tracker/head/pos_xyz', [pos_x, pos_y, pos_z])
-            # TODO ...
-            if ipd_pixels != 0:
-                # Compute the 3D position of the user's head
-                pos_x, pos_y, pos_z = compute3DPos(ibe_x, ibe_y, ipd_pixels)
-                print(f"3D position: {pos_x:.2f} - {pos_y:.2f} - {pos_z:.2f}")
-
-                # Head movements mapped to game controls
-                if pos_x > 2:  # Turn right
-                    if not previous_right:
-                        send_udp_command("P_RIGHT")  # Press right
-                        previous_right = True
-                    if previous_left:  # Release left if previously pressed
-                        send_udp_command("R_LEFT")
-                        previous_left = False
-                elif pos_x < -2:  # Turn left
-                    if not previous_left:
-                        send_udp_command("P_LEFT")  # Press left
-                        previous_left = True
-                    if previous_right:  # Release right if previously pressed
-                        send_udp_command("R_RIGHT")
-                        previous_right = False
-                else:  # Head is centered, release both left and right
-                    if previous_left:
-                        send_udp_command("R_LEFT")
-                        previous_left = False
-                    if previous_right:
-                        send_udp_command("R_RIGHT")
-                        previous_right = False
-
-                if pos_z < 30:  # Accelerate (close to the camera)
-                    if not previous_accelerate:
-                        send_udp_command("P_ACCELERATE")
-                        previous_accelerate = True
-                elif pos_z > 40:  # Brake (far from the camera)
-                    if not previous_brake:
-                        send_udp_command("P_BRAKE")
-                        previous_brake = True
-                    if previous_accelerate:  # Release accelerate
-                        send_udp_command("R_ACCELERATE")
-                        previous_accelerate = False
-                else:  # Neither brake nor accelerate
-                    if previous_brake:
-                        send_udp_command("R_BRAKE")
-                        previous_brake = False
-                    if previous_accelerate:
-                        send_udp_command("R_ACCELERATE")
-                        previous_accelerate = False
-            else:
-                print("Invalid interpupillary distance.")                          
+        submitted = time.perf_counter()
+        detector.detect_async(mp_image, timestamp_ms)
+
+        # Wait for this frame's result before sending the next (freshest) frame
+        result = res.results.wait(timestamp_ms, timeout=RESULT_TIMEOUT)
+        # After a timeout, the input of this frame stays for its late callback
+        res.forget_inputs(timestamp_ms)
+        scale.update((time.perf_counter() - submitted) * 1000)
+
+        # Track all the faces, or search the whole frame when they are lost
+        if ROI_TRACKING and result is not None and result.detections:
+            roi = roi_around(boxes_array(result.detections), frame_width, frame_height)
         else:
-          print("No face detected.")
-            
-        # Display the image with or without annotations
-        annotated_image = mp_image.numpy_view()
-        annotated_image = visualize(annotated_image, res.tracking_results)
-        bgr_annotated_image = cv2.cvtColor(annotated_image, cv2.COLOR_RGB2BGR)
-        cv2.imshow('img', bgr_annotated_image)
+            roi = None
+
+
+def control_stage(stop):
+    controls = HeadControls()
+    tracker = FaceTracker()
+    filters = None
+    if POSE_FILTERING:
+        filters = PoseFilters(FILTER_MIN_CUTOFF, FILTER_BETA, horizon_ms=PREDICTION_HORIZON_MS)
+    while not stop.is_set():
+        entry = res.results.take(timeout=0.1)
+        if entry is not None:
+            timestamp_ms, result = entry
+            process_result(timestamp_ms, result, controls, tracker, filters)
+
+
+def preview_stage(frames, stop, window=True, shared=None):
+    """Draw the latest frame and result PREVIEW_FPS times per second, into one
+    reused buffer, for the window and/or the shared-memory slot. Must run in the
+    main thread when there is a window (OpenCV GUI)."""
+    load_libraries()
+    frame_period = 1.0 / PREVIEW_FPS
+    next_frame = time.monotonic()
+    frame_seq = 0
+    display = None
+    while not stop.is_set():
+        seq, frame = frames.peek()
+        if frame is not None and seq != frame_seq:
+            frame_seq = seq
+            # Display the image with or without annotations, flipped to remove
+            # the mirror effect, drawn directly in BGR in the reused buffer
+            timestamp_ms, img_bgr = frame
+            if display is None or display.shape != img_bgr.shape:
+                display = np.empty_like(img_bgr)
+            result = res.results.find(timestamp_ms)
+            visualize(img_bgr, result, out=display, mirror=True, bgr=True)
+            if shared is not None:
+                shared.publish(display)
+            if window:
+                cv2.imshow('img', display)
+
+        next_frame = max(next_frame + frame_period, time.monotonic())
+        if window:
+            # Wait for Esc key to stop, until the next preview frame
+            delay_ms = max(1, int((next_frame - time.monotonic()) * 1000))
+            k = cv2.waitKey(delay_ms) & 0xff
+            if k == 27:
+                stop.set()
+        else:
+            stop.wait(next_frame - time.monotonic())
+
 
-        # Wait for Esc key to stop
-        k = cv2.waitKey(30) & 0xff
-        if k == 27:
-            break
+############################ program execution #############################
 
-    # release the video stream from the camera
+class TrackingSession:
+    """The face tracking application: nothing is opened or loaded until start().
 
+    start() sets the module state (socket, frame source, detector) and runs the
+    tracking until Esc / Ctrl+C. opencv, mediapipe and the model are loaded in
+    a background thread (warm_up, which can be called earlier), while the
+    socket and the frame source are opened; the frames are dropped until the
+    detector is ready. The time of each step is printed once it is.
+    """
 
-  cap.release()
-  # close the associated window
-  cv2.destroyAllWindows()
+    def __init__(self, source=0, ipd=REAL_IPD, headless=False, shm_name=None):
+        self.source = source  # Camera index, video file or "synthetic"
+        self.ipd = ipd
+        self.headless = headless
+        self.shm_name = shm_name
+        self.timings = []  # (step, seconds)
+        self.started = time.perf_counter()
+        self.warming = None
+
+    def timed(self, step, function, *args):
+        start = time.perf_counter()
+        value = function(*args)
+        self.timings.append((step, time.perf_counter() - start))
+        return value
+
+    def warm_up(self):
+        """Start loading opencv, mediapipe and the model in the background."""
+        if self.warming is None:
+            self.warming = threading.Thread(target=self.load_detector, daemon=True)
+            self.warming.start()
+
+    def load_detector(self):
+        global detector
+        self.timed("import opencv/mediapipe", load_libraries)
+        detector = self.timed("create detector", create_detector)
+        detector_ready.set()
+        print(self.report())
+
+    def report(self):
+        lines = ["Startup:"]
+        lines += [f"  {step:<24}{seconds * 1000:8.1f} ms" for step, seconds in self.timings]
+        lines.append(f"  {'detector ready after':<24}{(time.perf_counter() - self.started) * 1000:8.1f} ms")
+        return "\n".join(lines)
+
+    def start(self):
+        global user_ipd, sock, cap, frame_width, frame_height
+        self.started = time.perf_counter()
+        self.warm_up()
+        user_ipd = self.ipd
+        print(f"Tracking initialized with an interpupillary distance of {user_ipd} cm")
+
+        sock = self.timed("open socket", socket.socket, socket.AF_INET, socket.SOCK_DGRAM)  # Create a UDP socket
+        print("OSC connection established to " + address + " on port " + str(port) + "!")
+
+        # capture frames from a camera (or a file, or synthetic frames) and the time
+        cap, frame_width, frame_height = self.timed("open source", open_source, self.source)
+        print(f"Video size: {frame_width} x {frame_height}")
+
+        runtracking(self.headless, self.shm_name)
+
+
+def runtracking(headless=False, shm_name=None):
+
+    print("\nTracking started !!!")
+    if headless:
+        print("Headless mode, hit Ctrl+C to quit...")
+    else:
+        print("Hit ESC key to quit...")
+
+    frames = LatestValue()  # (timestamp_ms, BGR frame) from the camera
+    stop = threading.Event()
+    shared = None
+    if shm_name is not None:
+        shared = SharedFrameSlot(shm_name, (frame_height, frame_width, 3))
+        print(f"Preview published in shared memory '{shm_name}'")
+
+    # Stop on Ctrl+C / SIGTERM, in every mode
+    def request_stop(signum, frame):
+        stop.set()
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    stages = [
+        threading.Thread(target=capture_stage, args=(frames, stop), daemon=True),
+        threading.Thread(target=inference_stage, args=(frames, stop), daemon=True),
+        threading.Thread(target=control_stage, args=(stop,), daemon=True),
+    ]
+    for stage in stages:
+        stage.start()
+
+    if not headless:
+        preview_stage(frames, stop, window=True, shared=shared)
+    elif shared is not None:
+        preview_stage(frames, stop, window=False, shared=shared)
+    else:
+        # No GUI call at all, nothing to draw: just wait for a signal
+        while not stop.wait(1.0):
+            pass
+
+    stop.set()
+    frames.close()
+    res.results.close()
+    for stage in stages:
+        stage.join()
+    print(res.results.report())
+
+    # release the detector and the video stream from the camera
+    if detector_ready.is_set():
+        detector.close()
+    cap.release()
+    if shared is not None:
+        shared.close()
+    if not headless:
+        # close the associated window
+        cv2.destroyAllWindows()
+
+
+def main():
+    global PREVIEW_FPS, POSE_FILTERING
+
+    headless = False
+    shm_name = None
+    source = 0
+    ipd = REAL_IPD
+    # Reading command line
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == "--headless":
+            headless = True
+        elif sys.argv[i] == "--shm":
+            i += 1
+            shm_name = sys.argv[i]
+        elif sys.argv[i] == "--source":
+            i += 1
+            source = sys.argv[i]
+        elif sys.argv[i] == "--preview-fps":
+            i += 1
+            PREVIEW_FPS = float(sys.argv[i])
+        elif sys.argv[i] == "--max-age":
+            i += 1
+            res.results.max_age_ms = float(sys.argv[i])
+        elif sys.argv[i] == "--no-filter":
+            POSE_FILTERING = False
+        else:
+            ipd = float(sys.argv[i])
+        i += 1
 
+    try:
+        TrackingSession(source, ipd, headless, shm_name).start()
+    except IOError as error:
+        print(error)
+        sys.exit(1)
 
-############################ program execution #############################
 
-runtracking()
+if __name__ == "__main__":
+    main()
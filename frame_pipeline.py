@@ -0,0 +1,268 @@
+"""Building blocks of the face tracking pipeline (see face_tracking.runtracking)."""
+import struct
+import threading
+import time
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+from latency import LatencyHistogram
+
+
+class LatestValue:
+    """Single-slot buffer between two pipeline stages.
+
+    The producer never waits: put overwrites the previous value, so a slow
+    consumer skips stale values instead of queueing them. Every put gets a
+    sequence number, which lets a consumer wait for a value newer than the last
+    one it handled.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.value = None
+        self.seq = 0
+        self.closed = False
+
+    def put(self, value):
+        with self.cond:
+            self.value = value
+            self.seq += 1
+            self.cond.notify_all()
+
+    def peek(self):
+        """Return (seq, value) without waiting."""
+        with self.cond:
+            return self.seq, self.value
+
+    def get(self, last_seq=0, timeout=None):
+        """Wait for a value newer than last_seq, return (seq, value).
+
+        Returns (last_seq, None) on timeout or when the buffer is closed.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq != last_seq or self.closed, timeout):
+                return last_seq, None
+            if self.seq == last_seq:
+                return last_seq, None
+            return self.seq, self.value
+
+    def close(self):
+        """Wake up every consumer, for shutdown."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class ResultRing:
+    """Detection results keyed by the timestamp of their frame (time.monotonic, in ms).
+
+    The last `size` results are kept in a ring. The control stage takes them in
+    order, each one exactly once (take); the ones older than max_age_ms when
+    taken are dropped, as well as the ones overwritten before being taken. The
+    inference stage waits for the result of the frame it sent (wait), and the
+    preview looks up the result of the frame it draws (find).
+
+    Counters: delivered, stale (too old), overwritten (never taken), reused
+    (frames drawn with the result of an earlier frame), and a histogram of the
+    age of the delivered results.
+    """
+
+    def __init__(self, size=8, max_age_ms=150):
+        self.cond = threading.Condition()
+        self.entries = [None] * size  # (timestamp_ms, result)
+        self.written = 0  # Results put so far
+        self.taken = 0  # Results taken or dropped so far
+        self.max_age_ms = max_age_ms
+        self.closed = False
+        self.delivered = 0
+        self.stale = 0
+        self.overwritten = 0
+        self.reused = 0
+        self.age = LatencyHistogram()  # In microseconds
+
+    def put(self, timestamp_ms, result):
+        with self.cond:
+            self.entries[self.written % len(self.entries)] = (timestamp_ms, result)
+            self.written += 1
+            self.cond.notify_all()
+
+    def take(self, timeout=None):
+        """Wait for the next result not taken yet, return (timestamp_ms, result),
+        or None on timeout or when closed."""
+        with self.cond:
+            while True:
+                if not self.cond.wait_for(lambda: self.taken < self.written or self.closed, timeout):
+                    return None
+                if self.taken == self.written:
+                    return None
+                if self.written - self.taken > len(self.entries):
+                    self.overwritten += self.written - self.taken - len(self.entries)
+                    self.taken = self.written - len(self.entries)
+                entry = self.entries[self.taken % len(self.entries)]
+                self.taken += 1
+                age_ms = time.monotonic() * 1000 - entry[0]
+                if age_ms > self.max_age_ms:
+                    self.stale += 1
+                    continue
+                self.delivered += 1
+                self.age.record(int(age_ms * 1000))
+                return entry
+
+    def find(self, timestamp_ms):
+        """Result of the frame captured at timestamp_ms or, if it is not there
+        (yet), the newest one of an earlier frame (counted as reused)."""
+        with self.cond:
+            best = None
+            for i in range(max(0, self.written - len(self.entries)), self.written):
+                entry = self.entries[i % len(self.entries)]
+                if entry[0] == timestamp_ms:
+                    return entry[1]
+                if entry[0] < timestamp_ms and (best is None or entry[0] > best[0]):
+                    best = entry
+            if best is None:
+                return None
+            self.reused += 1
+            return best[1]
+
+    def wait(self, timestamp_ms, timeout=None):
+        """Wait for the result of the frame captured at timestamp_ms; None on timeout."""
+        def arrived():
+            entry = self.entries[(self.written - 1) % len(self.entries)] if self.written else None
+            return self.closed or (entry is not None and entry[0] >= timestamp_ms)
+        with self.cond:
+            if not self.cond.wait_for(arrived, timeout) or self.closed:
+                return None
+            for i in range(max(0, self.written - len(self.entries)), self.written):
+                entry = self.entries[i % len(self.entries)]
+                if entry[0] == timestamp_ms:
+                    return entry[1]
+            return None
+
+    def close(self):
+        """Wake up every consumer, for shutdown."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def report(self):
+        return ('results: {} delivered, {} stale (> {} ms), {} overwritten, {} reused by the preview\n'
+                'result age (ms): p50 {:.1f}, p95 {:.1f}, max {:.1f}').format(
+            self.delivered, self.stale, self.max_age_ms, self.overwritten, self.reused,
+            self.age.percentile(50) / 1e3, self.age.percentile(95) / 1e3, self.age.max / 1e3)
+
+
+class FramePool:
+    """Ring of preallocated frames the capture stage reads into (cap.read(pool.next())).
+
+    A frame is overwritten `count` captures after it was filled, so consumers
+    must be done with it (usually: convert or copy it into their own buffer)
+    within count - 1 frame periods.
+    """
+
+    def __init__(self, shape, count, dtype=np.uint8):
+        self.frames = [np.empty(shape, dtype) for _ in range(count)]
+        self.index = 0
+
+    def next(self):
+        self.index = (self.index + 1) % len(self.frames)
+        return self.frames[self.index]
+
+
+class AdaptiveScale:
+    """Inference scale following the measured detection latency.
+
+    The latency is smoothed (exponential moving average). Above the budget, the
+    scale steps down to the next of LEVELS; below HEADROOM times the budget, it
+    steps back up, without exceeding the initial scale. After a change, the
+    average is given COOLDOWN frames to reflect the new scale. When not
+    adaptive, the scale stays at its initial value.
+    """
+    LEVELS = (1.0, 0.75, 0.5, 0.375, 0.25)
+    SMOOTHING = 0.1
+    HEADROOM = 0.6
+    COOLDOWN = 15
+
+    def __init__(self, scale=1.0, budget_ms=25.0, adaptive=False):
+        self.value = scale
+        self.max_value = scale
+        self.budget_ms = budget_ms
+        self.adaptive = adaptive
+        self.latency_ms = None
+        self.cooldown = self.COOLDOWN
+
+    def update(self, latency_ms):
+        if self.latency_ms is None:
+            self.latency_ms = latency_ms
+        else:
+            self.latency_ms += self.SMOOTHING * (latency_ms - self.latency_ms)
+        if not self.adaptive:
+            return
+        if self.cooldown > 0:
+            self.cooldown -= 1
+            return
+        if self.latency_ms > self.budget_ms:
+            smaller = [level for level in self.LEVELS if level < self.value]
+            if smaller:
+                self.value = smaller[0]
+                self.cooldown = self.COOLDOWN
+        elif self.latency_ms < self.budget_ms * self.HEADROOM:
+            bigger = [level for level in self.LEVELS if self.value < level <= self.max_value]
+            if bigger:
+                self.value = bigger[-1]
+                self.cooldown = self.COOLDOWN
+
+
+class SharedFrameSlot:
+    """Latest frame published in named shared memory, for an external viewer
+    (see preview_viewer.py).
+
+    Layout: a header (sequence number, height, width, channels) followed by the
+    pixels. The writer makes the sequence odd while it copies a frame and even
+    once done, so a reader can detect and retry a torn read without any lock.
+    """
+    HEADER = struct.Struct('<QIII')
+
+    def __init__(self, name, shape=None):
+        """Create the slot for frames of `shape` (writer), or open it (reader)."""
+        self.owner = shape is not None
+        if self.owner:
+            size = self.HEADER.size + int(np.prod(shape))
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.HEADER.pack_into(self.shm.buf, 0, 0, *shape)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Attaching registers the segment with the resource tracker of this
+            # process, which would unlink it when the viewer exits (the
+            # track=False of Python 3.13 is not available before): the writer owns it
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        _, height, width, channels = self.HEADER.unpack_from(self.shm.buf, 0)
+        self.shape = (height, width, channels)
+        self.pixels = np.ndarray(self.shape, np.uint8, self.shm.buf, self.HEADER.size)
+        self.seq = 0
+
+    def publish(self, frame):
+        self.seq += 1
+        struct.pack_into('<Q', self.shm.buf, 0, 2 * self.seq - 1)
+        np.copyto(self.pixels, frame)
+        struct.pack_into('<Q', self.shm.buf, 0, 2 * self.seq)
+
+    def read(self, out, last_seq=0):
+        """Copy the latest frame into `out` if newer than last_seq; return its
+        sequence number (last_seq when there is nothing new)."""
+        for _ in range(3):
+            (seq,) = struct.unpack_from('<Q', self.shm.buf, 0)
+            if seq == last_seq or seq % 2:
+                return last_seq
+            np.copyto(out, self.pixels)
+            if struct.unpack_from('<Q', self.shm.buf, 0)[0] == seq:
+                return seq
+        return last_seq
+
+    def close(self):
+        del self.pixels
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass  # Already removed (by a viewer of an older version)
@@ -0,0 +1,237 @@
+"""Gesture recognition on the sensor streams: shake, double tap, flick.
+
+Each recognizer keeps the last samples of its sensor channel (yaw, pitch,
+touch...) in a fixed-size NumPy ring buffer, with running counts over its time
+window (seconds of the monotonic clock): a sample adds its contribution when it
+arrives and takes it back when it leaves the window, so the cost of a sample
+does not depend on the length of the window.
+
+Recognizers are pluggable: a subclass of Recognizer only decides from the
+counts of its Channel whether its gesture happened, and GestureEngine feeds
+each sample to the recognizers of its channel:
+
+    engine = GestureEngine([Shake('yaw', b'RESCUE', window=1.0, threshold=5.0, count=3)])
+    for command in engine.add('yaw', yaw, time.monotonic()):
+        send(command)
+"""
+import math
+
+import numpy as np
+
+RING_SIZE = 512  # Samples kept per channel, the oldest are dropped beyond (5 s at 100 Hz)
+
+# Flags of a sample
+SWING = 1     # Change since the previous sample above the threshold
+REVERSAL = 2  # Swing in the opposite direction of the previous swing
+RISE = 4      # Positive value after a value <= 0 (a touch)
+
+
+class Channel:
+    """Samples of one sensor channel over the last `window` seconds.
+
+    For each sample: its time, value, change since the previous sample
+    (wrapped to [-wrap/2, wrap/2) for angles, wrap=360) and flags (see SWING,
+    REVERSAL, RISE). The window keeps the number of samples of each flag, and
+    the sums of the values, of their squares and of the changes.
+    """
+
+    def __init__(self, window, threshold=0.0, wrap=None, size=RING_SIZE):
+        self.window = window
+        self.threshold = threshold
+        self.wrap = wrap
+        self.size = size
+        self.times = np.zeros(size)
+        self.values = np.zeros(size)
+        self.changes = np.zeros(size)
+        self.flags = np.zeros(size, np.int8)
+        self.previous = None  # Last value, also once out of the window
+        self.direction = 0  # Sign of the last swing
+        self.clear()
+
+    def clear(self):
+        """Empty the window (the last value and swing direction are kept)."""
+        self.head = 0  # Index of the oldest sample
+        self.count = 0
+        self.swings = 0
+        self.reversals = 0
+        self.rises = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.total_change = 0.0
+
+    def reset(self):
+        """Forget everything."""
+        self.clear()
+        self.previous = None
+        self.direction = 0
+
+    def add(self, t, value):
+        """Add the sample of time t (after the previous ones)."""
+        self.expire(t)
+        if self.count == self.size:
+            self.pop()
+        flags = 0
+        change = 0.0
+        previous = self.previous
+        if previous is not None:
+            change = value - previous
+            if self.wrap:
+                half = self.wrap / 2
+                change = (change + half) % self.wrap - half
+            if abs(change) > self.threshold:
+                direction = 1 if change > 0 else -1
+                flags = SWING | (REVERSAL if direction == -self.direction else 0)
+                self.direction = direction
+        if value > 0 and (previous is None or previous <= 0):
+            flags |= RISE
+        self.previous = value
+
+        i = (self.head + self.count) % self.size
+        self.times[i] = t
+        self.values[i] = value
+        self.changes[i] = change
+        self.flags[i] = flags
+        self.count += 1
+        self.count_flags(flags, 1)
+        self.total += value
+        self.total_squares += value * value
+        self.total_change += change
+
+    def expire(self, t):
+        """Remove the samples older than the window at time t."""
+        limit = t - self.window
+        times = self.times
+        while self.count and times[self.head] < limit:
+            self.pop()
+
+    def pop(self):
+        i = self.head
+        value = float(self.values[i])
+        self.count_flags(int(self.flags[i]), -1)
+        self.total -= value
+        self.total_squares -= value * value
+        self.total_change -= float(self.changes[i])
+        self.head = (i + 1) % self.size
+        self.count -= 1
+
+    def count_flags(self, flags, sign):
+        if flags:
+            if flags & SWING:
+                self.swings += sign
+            if flags & REVERSAL:
+                self.reversals += sign
+            if flags & RISE:
+                self.rises += sign
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def magnitude(self):
+        """Root mean square of the values of the window."""
+        return math.sqrt(max(self.total_squares, 0.0) / self.count) if self.count else 0.0
+
+
+class Recognizer:
+    """A gesture on one channel, sending `command` when its detected test is met.
+
+    After a detection, the window is emptied and no new detection happens for
+    `refractory` seconds.
+    """
+
+    def __init__(self, channel, command, window, threshold=0.0, wrap=None, refractory=0.0):
+        self.channel = channel
+        self.command = command
+        self.samples = Channel(window, threshold, wrap)
+        self.refractory = refractory
+        self.quiet_until = -math.inf
+
+    def feed(self, t, value):
+        """Add a sample, return the command if the gesture is recognized, None otherwise."""
+        samples = self.samples
+        samples.add(t, value)
+        if t < self.quiet_until or not self.detected(samples):
+            return None
+        samples.clear()
+        self.quiet_until = t + self.refractory
+        return self.command
+
+    def detected(self, samples):
+        raise NotImplementedError
+
+    def reset(self):
+        self.samples.reset()
+        self.quiet_until = -math.inf
+
+
+class Shake(Recognizer):
+    """Back-and-forth movement: `count` direction reversals of swings faster
+    than `threshold` per sample, within the window."""
+
+    def __init__(self, channel, command, window, threshold, count=3, wrap=360, refractory=None):
+        super().__init__(channel, command, window, threshold, wrap,
+                         window if refractory is None else refractory)
+        self.count = count
+
+    def detected(self, samples):
+        return samples.reversals >= self.count
+
+
+class DoubleTap(Recognizer):
+    """`taps` touches (rises of the value above 0) within the window."""
+
+    def __init__(self, channel, command, window, taps=2):
+        super().__init__(channel, command, window)
+        self.taps = taps
+
+    def detected(self, samples):
+        return samples.rises >= self.taps
+
+
+class Flick(Recognizer):
+    """Quick rotation: the value changes by more than `angle` within the window."""
+
+    def __init__(self, channel, command, window, angle, wrap=360, refractory=None):
+        super().__init__(channel, command, window, wrap=wrap,
+                         refractory=4 * window if refractory is None else refractory)
+        self.angle = angle
+
+    def detected(self, samples):
+        return abs(samples.total_change) > self.angle
+
+
+class GestureEngine:
+    """Feeds the samples of each channel to its recognizers."""
+
+    def __init__(self, recognizers=()):
+        self.channels = {}  # Channel name -> recognizers
+        for recognizer in recognizers:
+            self.register(recognizer)
+
+    def register(self, recognizer):
+        self.channels.setdefault(recognizer.channel, []).append(recognizer)
+
+    def add(self, channel, value, t):
+        """Feed a sample of time t (monotonic seconds), return the commands of
+        the gestures it completes (usually none)."""
+        commands = []
+        for recognizer in self.channels.get(channel, ()):
+            command = recognizer.feed(t, value)
+            if command is not None:
+                commands.append(command)
+        return commands
+
+    def reset(self):
+        for recognizers in self.channels.values():
+            for recognizer in recognizers:
+                recognizer.reset()
+
+
+def default_recognizers(params):
+    """The gestures of the Controller, with the thresholds of params
+    (controller.Parameters): shake the phone (yaw) for RESCUE, double tap for
+    FIRE, flick it forward or backward (pitch) for NITRO."""
+    return [
+        Shake('yaw', b'RESCUE', params.SHAKE_WINDOW, params.SHAKE_THRESHOLD, params.SHAKE_COUNT),
+        DoubleTap('touch', b'FIRE', params.DOUBLE_TAP_THRESHOLD),
+        Flick('pitch', b'NITRO', params.FLICK_WINDOW, params.FLICK_ANGLE),
+    ]
@@ -0,0 +1,76 @@
+"""Steering and acceleration from the direction of the hands (Leap Motion).
+
+handtracking.cs sends /hand/left/direction and /hand/right/direction (x, y, z)
+every Unity frame, for each hand seen. Hands keeps the latest vector of both
+hands in a (2, 3) array; at each control tick, the yaw (steering) and pitch
+(acceleration) angles of both hands are computed in one vectorized step, and
+averaged over the hands seen recently. Each angle gives an analog deflection
+between -1 and 1: 0 inside its dead zone, 1 from its full angle, which the
+Controller turns into the PWM duty cycle of the key.
+
+Unity coordinates: x right, y up, z forward. Fingers pointing right steer
+right, fingers pointing up accelerate and down brake.
+"""
+import math
+
+import numpy as np
+
+LEFT = 0
+RIGHT = 1
+HAND_TIMEOUT = 0.2  # A hand not seen for this time (in seconds) does not count anymore
+
+
+class Hands:
+    """Latest direction vector of both hands (rows LEFT and RIGHT) and its arrival time."""
+
+    def __init__(self, timeout=HAND_TIMEOUT):
+        self.timeout = timeout
+        self.directions = np.zeros((2, 3))
+        self.ground = np.zeros((2, 2))  # Per hand: z and length in the horizontal plane
+        self.times = [-math.inf, -math.inf]
+        self.changed = False  # New vectors since the last call to controls
+        self.expiry = math.inf  # Time when a hand seen stops counting
+
+    def store(self, hand, values, now):
+        """New direction (x, y, z) of a hand (OSC thread)."""
+        self.directions[hand] = values[:3]
+        self.times[hand] = now
+        self.changed = True
+
+    def reset(self):
+        """Forget the hands (they stop counting until the next vectors)."""
+        self.times = [-math.inf, -math.inf]
+        self.changed = False
+        self.expiry = math.inf
+
+    def controls(self, now, params):
+        """(steering, acceleration) deflections between -1 and 1 at time now,
+        (0, 0) when no hand is seen. params gives the angles (see
+        controller.Parameters): HAND_STEER_ANGLE and HAND_STEER_FULL, idem for
+        ACCEL, and HAND_ACCEL_OFFSET, the pitch of the hands at rest."""
+        self.changed = False
+        limit = now - self.timeout
+        seen = [t > limit for t in self.times]
+        count = sum(seen)
+        if not count:
+            self.expiry = math.inf
+            return 0.0, 0.0
+        self.expiry = min(t for t, s in zip(self.times, seen) if s) + self.timeout
+
+        # Yaw and pitch of both hands at once: atan2((x, y), (z, hypot(x, z))),
+        # then their mean over the hands seen
+        d = self.directions
+        ground = self.ground
+        ground[:, 0] = d[:, 2]
+        np.hypot(d[:, 0], d[:, 2], out=ground[:, 1])
+        angles = np.arctan2(d[:, :2], ground)
+        yaw, pitch = (np.dot(seen, angles) * (180.0 / math.pi / count)).tolist()
+        return (deflection(yaw, params.HAND_STEER_ANGLE, params.HAND_STEER_FULL),
+                deflection(pitch - params.HAND_ACCEL_OFFSET, params.HAND_ACCEL_ANGLE,
+                           params.HAND_ACCEL_FULL))
+
+
+def deflection(angle, dead, full):
+    """Analog value of an angle: 0 up to dead, -1 or 1 from full, linear between."""
+    value = min(max((abs(angle) - dead) / (full - dead), 0.0), 1.0)
+    return math.copysign(value, angle) if value else 0.0
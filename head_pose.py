@@ -0,0 +1,217 @@
+"""Vectorized head pose for every detected face, and face identities across frames.
+
+The detections of a frame are turned into arrays once (keypoints_array,
+boxes_array), then the pixel conversion, interpupillary distance, eye center and
+3D position of all the faces are computed by NumPy in one call, whatever the
+number of faces. FaceTracker gives each face an ID that stays the same from one
+frame to the next, so that several players can share the camera.
+"""
+import numpy as np
+
+RIGHT_EYE = 0  # Index of the eyes in the BlazeFace keypoints
+LEFT_EYE = 1
+
+
+def keypoints_array(detections):
+    """(N, K, 2) array of the normalized keypoints of N detections."""
+    if not detections:
+        return np.empty((0, 0, 2))
+    return np.array([[(k.x, k.y) for k in d.keypoints] for d in detections], dtype=np.float64)
+
+
+def boxes_array(detections):
+    """(N, 4) array of the bounding boxes (x, y, w, h), in pixels."""
+    return np.array([(d.bounding_box.origin_x, d.bounding_box.origin_y,
+                      d.bounding_box.width, d.bounding_box.height) for d in detections],
+                    dtype=np.float64).reshape(len(detections), 4)
+
+
+def to_pixels(normalized, width, height, mirror=False):
+    """Vectorized _normalized_to_pixel_coordinates, on an (..., 2) array.
+
+    With mirror, x is flipped (1 - x) first, as for an image flipped horizontally.
+    Coordinates inside the image are clamped to the last pixel, the others are
+    kept as they are.
+    """
+    normalized = normalized.copy()
+    if mirror:
+        normalized[..., 0] = 1.0 - normalized[..., 0]
+    size = np.array((width, height), dtype=np.float64)
+    pixels = np.floor(normalized * size)
+    inside = (normalized >= 0.0) & (normalized <= 1.0)
+    inside = inside[..., 0:1] & inside[..., 1:2]
+    return np.where(inside, np.minimum(pixels, size - 1), pixels)
+
+
+def compute_poses(keypoints, width, height, ipd_cm, focal, mirror=False):
+    """3D position (x, y, z) in cm of every face, in the camera reference frame.
+
+    keypoints: (N, K, 2) normalized keypoints (see keypoints_array).
+    Returns an (N, 3) array and an (N,) boolean array, False for the faces whose
+    eyes are on the same pixel (no depth; their row is NaN).
+    """
+    eyes = to_pixels(keypoints[:, (RIGHT_EYE, LEFT_EYE)], width, height, mirror)
+    ipd_pixels = np.hypot(*(eyes[:, 0] - eyes[:, 1]).T)
+    center = eyes.mean(axis=1)
+    valid = ipd_pixels != 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(valid, ipd_cm * focal / ipd_pixels, np.nan)
+    poses = np.empty((len(keypoints), 3))
+    poses[:, 0] = (center[:, 0] - width / 2) * z / focal
+    poses[:, 1] = (center[:, 1] - height / 2) * z / focal
+    poses[:, 2] = z
+    return poses, valid
+
+
+def iou_matrix(a, b):
+    """Intersection over union of every box of a (N, 4) with every box of b (M, 4)."""
+    a = a[:, None, :]
+    b = b[None, :, :]
+    overlap_w = np.clip(np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    overlap_h = np.clip(np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = overlap_w * overlap_h
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - inter
+    return np.where(union > 0, inter / np.where(union > 0, union, 1), 0.0)
+
+
+def mutual_best(score, threshold):
+    """Pairs (i, j) where j is the best column of row i, i the best row of
+    column j, and the score is above threshold (minimum for a distance, use -d)."""
+    if score.size == 0:
+        return np.empty(0, int), np.empty(0, int)
+    best_col = score.argmax(axis=1)
+    best_row = score.argmax(axis=0)
+    rows = np.arange(score.shape[0])
+    keep = (best_row[best_col] == rows) & (score[rows, best_col] > threshold)
+    return rows[keep], best_col[keep]
+
+
+class FaceTracker:
+    """Lightweight IoU / centroid tracker giving each face a persistent ID.
+
+    Detections are matched to the tracks of the previous frames by mutual best
+    IoU; the ones left (fast motion) by mutual nearest centroid, closer than the
+    size of the face. Unmatched detections start new tracks, tracks unmatched
+    for more than max_missed frames are dropped.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed=10):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.ids = np.empty(0, int)
+        self.boxes = np.empty((0, 4))
+        self.missed = np.empty(0, int)
+        self.next_id = 0
+
+    def update(self, boxes):
+        """Match the (N, 4) boxes of a frame, return their (N,) IDs."""
+        ids = np.full(len(boxes), -1)
+        track_matched = np.zeros(len(self.ids), bool)
+
+        rows, cols = mutual_best(iou_matrix(boxes, self.boxes), self.iou_threshold)
+        ids[rows] = self.ids[cols]
+        track_matched[cols] = True
+
+        # Second pass on the centroids, for what IoU did not match
+        free_rows = np.flatnonzero(ids < 0)
+        free_cols = np.flatnonzero(~track_matched)
+        if len(free_rows) and len(free_cols):
+            a = boxes[free_rows, :2] + boxes[free_rows, 2:] / 2
+            b = self.boxes[free_cols, :2] + self.boxes[free_cols, 2:] / 2
+            distance = np.hypot(*(a[:, None, :] - b[None, :, :]).transpose(2, 0, 1))
+            size = np.maximum(boxes[free_rows, 2:].max(axis=1)[:, None], self.boxes[free_cols, 2:].max(axis=1)[None, :])
+            r, c = mutual_best(np.where(distance < size, -distance, -np.inf), -np.inf)
+            ids[free_rows[r]] = self.ids[free_cols[c]]
+            track_matched[free_cols[c]] = True
+
+        new = ids < 0
+        ids[new] = np.arange(self.next_id, self.next_id + new.sum())
+        self.next_id += int(new.sum())
+
+        # Tracks: the matched and new ones with their current box, plus the
+        # unmatched ones still within max_missed
+        keep = ~track_matched & (self.missed < self.max_missed)
+        self.ids = np.concatenate((ids, self.ids[keep]))
+        self.boxes = np.concatenate((boxes, self.boxes[keep]))
+        self.missed = np.concatenate((np.zeros(len(ids), int), self.missed[keep] + 1))
+        return ids
+
+
+class OneEuroFilter:
+    """One-Euro filter on a vector (e.g. x, y, z), with timestamps in ms.
+
+    A low-pass filter whose cutoff frequency grows with the speed: slow head
+    movements are smoothed (no jitter), fast ones are followed closely (little
+    lag). The filtered velocity is kept, to predict the value at a later time.
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.05, d_cutoff=1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.value = None
+        self.velocity = None
+        self.timestamp_ms = None
+
+    @staticmethod
+    def alpha(cutoff, dt):
+        tau = 1.0 / (2 * np.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def filter(self, value, timestamp_ms):
+        """Add the measure taken at timestamp_ms, return the filtered value."""
+        value = np.asarray(value, dtype=np.float64)
+        if self.value is None:
+            self.value = value
+            self.velocity = np.zeros_like(value)
+        else:
+            dt = (timestamp_ms - self.timestamp_ms) / 1000.0
+            if dt <= 0:
+                return self.value
+            velocity = (value - self.value) / dt
+            self.velocity = self.velocity + self.alpha(self.d_cutoff, dt) * (velocity - self.velocity)
+            cutoff = self.min_cutoff + self.beta * np.abs(self.velocity)
+            self.value = self.value + self.alpha(cutoff, dt) * (value - self.value)
+        self.timestamp_ms = timestamp_ms
+        return self.value
+
+    def predict(self, timestamp_ms, horizon_ms):
+        """Filtered value extrapolated to timestamp_ms, at most horizon_ms ahead
+        of the last measure (constant velocity)."""
+        ahead = min(max(timestamp_ms - self.timestamp_ms, 0), horizon_ms) / 1000.0
+        return self.value + self.velocity * ahead
+
+
+class PoseFilters:
+    """One OneEuroFilter per tracked face ID, for the (N, 3) poses of a frame.
+
+    The poses are measured on a frame captured some time ago (detection
+    latency): update filters them and predicts them at the current time, so
+    that the controls react to where the head is now. Filters without a
+    measure for forget_ms are dropped.
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.05, d_cutoff=1.0, horizon_ms=100, forget_ms=1000):
+        self.params = (min_cutoff, beta, d_cutoff)
+        self.horizon_ms = horizon_ms
+        self.forget_ms = forget_ms
+        self.filters = {}
+
+    def update(self, ids, poses, valid, timestamp_ms, now_ms):
+        """Return the (N, 3) poses filtered and predicted at now_ms (NaN where not valid)."""
+        predicted = np.full_like(poses, np.nan)
+        for i, face_id in enumerate(ids):
+            face_filter = self.filters.get(face_id)
+            if valid[i]:
+                if face_filter is None:
+                    face_filter = self.filters[face_id] = OneEuroFilter(*self.params)
+                face_filter.filter(poses[i], timestamp_ms)
+            if face_filter is not None:
+                predicted[i] = face_filter.predict(now_ms, self.horizon_ms)
+        self.forget(timestamp_ms)
+        return predicted
+
+    def forget(self, timestamp_ms):
+        self.filters = {face_id: f for face_id, f in self.filters.items()
+                        if timestamp_ms - f.timestamp_ms <= self.forget_ms}
@@ -0,0 +1,167 @@
+"""Key-injection backends of the STK input server.
+
+A backend provides the functions named in the bindings of STK_input_server:
+press(key), release(key) and press_and_release(key). It may also provide
+prepare(key), called once per binding by build_dispatch, whose result is
+given to these functions instead of the key name (to resolve names and
+reject unknown keys at startup), and close(), called when the server stops.
+
+  keyboard     the keyboard module (needs root on Linux, hooks the whole keyboard)
+  uinput       a virtual keyboard created through /dev/uinput (Linux): one write
+               per action, no hook (needs write access to /dev/uinput)
+  null         counts the key events, injects nothing (to measure the dispatch)
+  record:FILE  writes the key events to FILE, one per line, with their
+               latency.now_ns timestamp, injects nothing (to check key timing)
+
+open_backend('uinput') returns the backend from its name (the -k option of
+the server).
+"""
+import os
+import struct
+import time
+
+from latency import now_ns
+
+BACKENDS = ('keyboard', 'uinput', 'null', 'record')
+
+
+class KeyboardBackend:
+    """The keyboard module, as the server always used it."""
+
+    def __init__(self):
+        import keyboard
+        self.press = keyboard.press
+        self.release = keyboard.release
+        self.press_and_release = keyboard.press_and_release
+
+
+## uinput (linux/uinput.h, linux/input-event-codes.h)
+
+UI_SET_EVBIT = 0x40045564
+UI_SET_KEYBIT = 0x40045565
+UI_DEV_SETUP = 0x405c5503
+UI_DEV_CREATE = 0x5501
+UI_DEV_DESTROY = 0x5502
+BUS_USB = 0x03
+EV_SYN = 0x00
+EV_KEY = 0x01
+SYN_REPORT = 0
+INPUT_EVENT = struct.Struct('llHHi')  # struct input_event: timeval, type, code, value
+UINPUT_SETUP = struct.Struct('HHHH80sI')  # struct uinput_setup: input_id, name, ff_effects_max
+
+# Key names (as in the bindings) -> Linux key codes
+KEY_CODES = {'escape': 1, 'backspace': 14, 'tab': 15, 'enter': 28, 'space': 57,
+             'up': 103, 'left': 105, 'right': 106, 'down': 108,
+             'left ctrl': 29, 'left shift': 42, ',': 51}
+KEY_CODES.update({str(digit): 2 + (digit - 1) % 10 for digit in range(10)})
+for row, first in (('qwertyuiop', 16), ('asdfghjkl', 30), ('zxcvbnm', 44)):
+    KEY_CODES.update({letter: first + i for i, letter in enumerate(row)})
+
+
+class UinputBackend:
+    """Virtual keyboard device; each action is one write of its events."""
+
+    def __init__(self, path='/dev/uinput', name=b'STK input server', settle=0.2):
+        import fcntl
+        self.fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        try:
+            fcntl.ioctl(self.fd, UI_SET_EVBIT, EV_KEY)
+            for code in sorted(set(KEY_CODES.values())):
+                fcntl.ioctl(self.fd, UI_SET_KEYBIT, code)
+            fcntl.ioctl(self.fd, UI_DEV_SETUP, UINPUT_SETUP.pack(BUS_USB, 0x1, 0x1, 1, name, 0))
+            fcntl.ioctl(self.fd, UI_DEV_CREATE)
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.ioctl = fcntl.ioctl
+        # The desktop needs a moment to pick up the new device
+        time.sleep(settle)
+
+    def prepare(self, key):
+        """The events of each action on key, written as they are by the actions."""
+        if key not in KEY_CODES:
+            raise ValueError('No uinput key code for {!r}'.format(key))
+        code = KEY_CODES[key]
+        sync = INPUT_EVENT.pack(0, 0, EV_SYN, SYN_REPORT, 0)
+        press = INPUT_EVENT.pack(0, 0, EV_KEY, code, 1) + sync
+        release = INPUT_EVENT.pack(0, 0, EV_KEY, code, 0) + sync
+        return press, release
+
+    def press(self, events):
+        os.write(self.fd, events[0])
+
+    def release(self, events):
+        os.write(self.fd, events[1])
+
+    def press_and_release(self, events):
+        os.write(self.fd, events[0] + events[1])
+
+    def close(self):
+        self.ioctl(self.fd, UI_DEV_DESTROY)
+        os.close(self.fd)
+
+
+class NullBackend:
+    """Injects nothing, counts the key events."""
+
+    def __init__(self):
+        self.events = 0
+
+    def press(self, key):
+        self.events += 1
+
+    def release(self, key):
+        self.events += 1
+
+    def press_and_release(self, key):
+        self.events += 2
+
+    def report(self):
+        return '{} key events (null backend)'.format(self.events)
+
+
+class RecordingBackend:
+    """Injects nothing, writes `timestamp_ns action key` lines to a file.
+
+    The actions run on the key-injection thread only, so the file needs no lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w')
+        self.events = 0
+
+    def record(self, action, key):
+        self.events += 1
+        self.file.write('{} {} {}\n'.format(now_ns(), action, key))
+
+    def press(self, key):
+        self.record('press', key)
+
+    def release(self, key):
+        self.record('release', key)
+
+    def press_and_release(self, key):
+        self.record('press_and_release', key)
+
+    def close(self):
+        self.file.close()
+
+    def report(self):
+        return '{} key events recorded in {}'.format(self.events, self.path)
+
+
+def open_backend(spec):
+    """Backend from its name: keyboard, uinput, null or record:FILE."""
+    name, _, argument = spec.partition(':')
+    if name == 'keyboard':
+        return KeyboardBackend()
+    if name == 'uinput':
+        return UinputBackend(argument or '/dev/uinput')
+    if name == 'null':
+        return NullBackend()
+    if name == 'record':
+        if not argument:
+            raise ValueError('record needs a file: record:FILE')
+        return RecordingBackend(argument)
+    raise ValueError('Unknown key backend {} (one of {})'.format(name, ', '.join(BACKENDS)))
@@ -0,0 +1,128 @@
+"""Opt-in latency tracing, from the OSC message to the key injection.
+
+The clock is time.perf_counter_ns: it is system-wide on Linux (CLOCK_MONOTONIC)
+and Windows (QueryPerformanceCounter), so stamps taken by the controller and by
+STK_input_server can be compared as long as both run on the same machine.
+
+Stamps carried with a command (see stk_protocol):
+  recv      the OSC message of a bound callback reaches OSCServer.dispatch (or
+            the players.py router), before the address lookup and the profile lock
+  callback  the Controller callback handling it is invoked
+  send      the command leaves Controller.send_data / flush
+and, in STK_input_server:
+  server    the datagram is handled by the receive loop
+  inject    the key-injection worker calls the keyboard
+  done      the keyboard call returned
+"""
+import math
+import time
+
+now_ns = time.perf_counter_ns
+
+# Stage name, first stamp, last stamp (indices in the stamp tuple)
+STAGES = (('osc', 0, 1),
+          ('control', 1, 2),
+          ('udp', 2, 3),
+          ('queue', 3, 4),
+          ('inject', 4, 5),
+          ('total', 0, 5))
+
+
+class Tracer:
+    """Sender side: remembers the stamps of the last OSC message handled, and adds
+    them to the next command sent. Commands sent later without a new message
+    (the following PWM edges for instance) are not traced, nor those sent
+    before the callback of the last message received."""
+    __slots__ = ('recv_ns', 'callback_ns')
+
+    def __init__(self):
+        self.recv_ns = 0
+        self.callback_ns = 0
+
+    def received(self, ns=None):
+        # The callback stamp of an older message must not go with this one
+        self.recv_ns = now_ns() if ns is None else ns
+        self.callback_ns = 0
+
+    def called(self):
+        self.callback_ns = now_ns()
+
+    def stamps(self):
+        """Stamps to send with the current command, or None if already sent or
+        if the callback of the last message has not run yet."""
+        recv_ns = self.recv_ns
+        callback_ns = self.callback_ns
+        if not recv_ns or callback_ns < recv_ns:
+            return None
+        self.recv_ns = self.callback_ns = 0
+        return recv_ns, callback_ns, now_ns()
+
+
+class LatencyHistogram:
+    """Log-linear histogram of durations in nanoseconds.
+
+    16 buckets per power of two (about 6% resolution), fixed memory, O(1) record.
+    """
+    SUB_BITS = 4
+    SUB_COUNT = 1 << SUB_BITS
+
+    def __init__(self):
+        self.counts = [0] * (64 * self.SUB_COUNT)
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        if ns < 0:
+            ns = 0
+        e = ns.bit_length()
+        if e <= self.SUB_BITS + 1:
+            index = ns
+        else:
+            shift = e - self.SUB_BITS - 1
+            index = shift * self.SUB_COUNT + (ns >> shift)
+        self.counts[index] += 1
+        self.total += 1
+        if ns > self.max:
+            self.max = ns
+
+    def bucket_bounds(self, index):
+        if index < 2 * self.SUB_COUNT:
+            return index, index + 1
+        shift, top = divmod(index, self.SUB_COUNT)
+        top += self.SUB_COUNT
+        shift -= 1
+        return top << shift, (top + 1) << shift
+
+    def percentile(self, p):
+        """Approximate p-th percentile in nanoseconds (middle of its bucket)."""
+        if not self.total:
+            return 0
+        target = max(1, math.ceil(self.total * p / 100.0))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                low, high = self.bucket_bounds(index)
+                return min((low + high) // 2, self.max)
+        return self.max
+
+
+class LatencyStats:
+    """One histogram per stage, fed with complete stamp tuples."""
+
+    def __init__(self):
+        self.histograms = {name: LatencyHistogram() for name, _, _ in STAGES}
+
+    def record(self, stamps):
+        for name, first, last in STAGES:
+            self.histograms[name].record(stamps[last] - stamps[first])
+
+    def report(self):
+        lines = ['{:<10}{:>8}{:>12}{:>12}{:>12}{:>12}'.format(
+            'stage', 'count', 'p50 (us)', 'p95 (us)', 'p99 (us)', 'max (us)')]
+        for name, _, _ in STAGES:
+            h = self.histograms[name]
+            lines.append('{:<10}{:>8}{:>12.1f}{:>12.1f}{:>12.1f}{:>12.1f}'.format(
+                name, h.total, h.percentile(50) / 1e3, h.percentile(95) / 1e3,
+                h.percentile(99) / 1e3, h.max / 1e3))
+        return '\n'.join(lines)
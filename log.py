@@ -0,0 +1,148 @@
+"""Asynchronous, rate-limited logging for the hot paths (OSC callbacks, tracking loop).
+
+print blocks the calling thread until the terminal has written the text: on a
+slow terminal, that delays the OSC thread or the capture loop. Here a call site
+only appends (format, args) to a bounded buffer, and a background thread does
+the formatting and the writing.
+
+Each call site is a Site, created once at module level with its level, a
+maximum rate (messages per second, the others are dropped and counted) and a
+sampling period (only one message out of `every`):
+
+    log_values = log.site(log.DEBUG, rate=10)
+    ...
+    if log_values.enabled:
+        log_values("got values for x: {}", values)
+
+When the level of a site is below the current level, `enabled` is False and
+the cost is one attribute test (the arguments are not even built). The level
+is INFO by default, set by the LOG_LEVEL environment variable (debug, info,
+warning, error) or set_level().
+"""
+import atexit
+import collections
+import os
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+BUFFER_SIZE = 4096  # Messages waiting for the writer; the oldest are dropped beyond
+
+current_level = LEVELS.get(os.environ.get('LOG_LEVEL', 'info').lower(), INFO)
+sites = []
+
+
+class Writer:
+    """Background thread writing the messages of all the sites, in order."""
+
+    def __init__(self, stream=None, size=BUFFER_SIZE):
+        self.stream = stream
+        self.buffer = collections.deque(maxlen=size)
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dropped = 0
+
+    def put(self, message):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(message)
+        if self.thread is None:
+            self.start()
+        self.wakeup.set()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.write()
+
+    def write(self):
+        """Format and write the waiting messages (also called by flush)."""
+        with self.lock:
+            stream = self.stream or sys.stdout
+            lines = []
+            while self.buffer:
+                fmt, args, suppressed = self.buffer.popleft()
+                if callable(fmt):
+                    line = fmt(*args)
+                else:
+                    line = fmt.format(*args) if args else fmt
+                if suppressed:
+                    line += ' ({} similar messages suppressed)'.format(suppressed)
+                lines.append(line)
+            if self.dropped:
+                lines.append('({} log messages dropped)'.format(self.dropped))
+                self.dropped = 0
+            if lines:
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+
+
+writer = Writer()
+
+
+class Site:
+    """One logging call site, see the module docstring."""
+    __slots__ = ('level', 'interval', 'every', 'enabled', 'next_time', 'count', 'suppressed')
+
+    def __init__(self, level=INFO, rate=None, every=1):
+        self.level = level
+        self.interval = 1.0 / rate if rate else 0.0
+        self.every = every
+        self.enabled = level >= current_level
+        self.next_time = 0.0
+        self.count = 0
+        self.suppressed = 0
+
+    def __call__(self, fmt, *args):
+        """Log fmt.format(*args), or fmt(*args) if fmt is a function returning
+        the line, unless sampled out or over the rate."""
+        if not self.enabled:
+            return
+        self.count += 1
+        if self.every > 1 and self.count % self.every:
+            return
+        if self.interval:
+            now = time.monotonic()
+            if now < self.next_time:
+                self.suppressed += 1
+                return
+            self.next_time = now + self.interval
+        writer.put((fmt, args, self.suppressed))
+        self.suppressed = 0
+
+
+def site(level=INFO, rate=None, every=1):
+    """New call site (at module level): level, max messages per second, 1 out of `every`."""
+    new = Site(level, rate, every)
+    sites.append(new)
+    return new
+
+
+def set_level(new_level):
+    """Set the level (DEBUG... or its name) of all the sites, existing and future."""
+    global current_level
+    current_level = LEVELS[new_level.lower()] if isinstance(new_level, str) else new_level
+    for s in sites:
+        s.enabled = s.level >= current_level
+
+
+def flush():
+    """Write the waiting messages now (at exit, or before a synchronous print)."""
+    writer.write()
+
+
+atexit.register(flush)
@@ -1,19 +1,50 @@
 from controller import Controller
 from osc_server import OSCServer
+from osc_replay import OSCRecorder
+from profiles import builtin_profiles, load_profiles, ProfileWatcher
 from time import sleep
+import sys
 
 def main():
     address = ('localhost', 6006)
-    controller = Controller(address)
-    osc_server = OSCServer(controller)
-    osc_server.bind_callbacks()
+    # -b: send the commands of a control tick or callback in one datagram
+    # -t: add latency tracing stamps to the commands (see latency.py)
+    # -c: coalesce the high-rate sensor streams, applied once per control tick
+    controller = Controller(address, batch='-b' in sys.argv[1:], trace='-t' in sys.argv[1:],
+                            coalesce='-c' in sys.argv[1:])
+    # -r FILE: record the OSC session in FILE (see osc_replay.py)
+    recorder = None
+    if '-r' in sys.argv[1:]:
+        recorder = OSCRecorder(sys.argv[sys.argv.index('-r') + 1])
+    # -p FILE: input profiles (see profiles.py), reloaded when FILE changes;
+    # the MODES otherwise. Switch with the OSC message /stk/profile <name>
+    profiles_path = None
+    profiles, default = builtin_profiles(), 'pad'
+    if '-p' in sys.argv[1:]:
+        profiles_path = sys.argv[sys.argv.index('-p') + 1]
+        profiles, default = load_profiles(profiles_path)
+    # -m MODE: initial input mode / profile (pad, or the default of the profiles file)
+    if '-m' in sys.argv[1:]:
+        default = sys.argv[sys.argv.index('-m') + 1]
+    if default not in profiles:
+        print('Unknown profile {} (one of {})'.format(default, ', '.join(profiles)))
+        controller.stop()
+        sys.exit(1)
+    osc_server = OSCServer(controller, recorder=recorder)
+    osc_server.use_profiles(profiles, default)
+    watcher = ProfileWatcher(profiles_path, osc_server) if profiles_path else None
 
     try:
         sleep(1000)
     except KeyboardInterrupt:
         pass
     finally:
+        if watcher is not None:
+            watcher.stop()
         osc_server.stop()
+        controller.stop()
+        if controller.slots is not None:
+            print(controller.slots.report())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,229 @@
+"""Record OSC sensor sessions and replay them into OSCServer / Controller.
+
+usage:
+  python mainTP1.py -r session.osclog              record while playing
+  python osc_replay.py replay session.osclog [mode] [speed]
+  python osc_replay.py compare session.osclog
+
+`speed` is a factor of the real time (1, 4...) or 'max' (default). At max speed
+the Controller control loop is not started: its update_control is called with
+the recorded timestamps instead, so the command stream does not depend on the
+machine and two replays of a log give the same commands. The commands are sent
+by UDP to a CaptureSink on localhost, not to the game.
+
+Log format (little endian):
+  header   b'OSCLOG1\\n'
+  record   <QHB  time in us since the start of the recording, address id, count
+           count == 0xFF defines address id: <H length + address bytes
+           otherwise `count` values follow, each a type byte and its payload:
+           b'f' <f, b'i' <i, b'h' <q, b's' <H length + bytes, b'T' / b'F' (no payload)
+"""
+import math
+import socket
+import struct
+import sys
+import threading
+import time
+
+from controller import Controller, PWM_PERIOD
+from osc_server import OSCServer, MODES
+from stk_protocol import BATCH_SEP, TRACE_SEP
+
+MAGIC = b'OSCLOG1\n'
+RECORD = struct.Struct('<QHB')
+LENGTH = struct.Struct('<H')
+FLOAT = struct.Struct('<f')
+INT = struct.Struct('<i')
+LONG = struct.Struct('<q')
+DEFINE = 0xFF
+END_MARKER = b'END_OF_REPLAY'
+
+
+class OSCRecorder:
+    """Appends every OSC message received to a compact binary log."""
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.ids = {}  # address -> id
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, address, values):
+        t = int((time.monotonic() - self.start) * 1e6)
+        parts = []
+        for v in values:
+            if isinstance(v, bool):
+                parts.append(b'T' if v else b'F')
+            elif isinstance(v, float):
+                parts.append(b'f' + FLOAT.pack(v))
+            elif isinstance(v, int):
+                if -2**31 <= v < 2**31:
+                    parts.append(b'i' + INT.pack(v))
+                else:
+                    parts.append(b'h' + LONG.pack(v))
+            else:
+                if isinstance(v, str):
+                    v = v.encode('utf8')
+                parts.append(b's' + LENGTH.pack(len(v)) + v)
+
+        with self.lock:
+            address_id = self.ids.get(address)
+            if address_id is None:
+                address_id = self.ids[address] = len(self.ids)
+                self.file.write(RECORD.pack(t, address_id, DEFINE) + LENGTH.pack(len(address)) + address)
+            self.file.write(RECORD.pack(t, address_id, len(parts)) + b''.join(parts))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_log(path):
+    """Yield (time in seconds, address, values) for every message of a log."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError('{} is not an OSC log'.format(path))
+    addresses = {}
+    offset = len(MAGIC)
+    while offset < len(data):
+        t, address_id, count = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if count == DEFINE:
+            (length,) = LENGTH.unpack_from(data, offset)
+            offset += LENGTH.size
+            addresses[address_id] = data[offset:offset + length]
+            offset += length
+            continue
+        values = []
+        for _ in range(count):
+            tag = data[offset:offset + 1]
+            offset += 1
+            if tag == b'f':
+                values.append(FLOAT.unpack_from(data, offset)[0])
+                offset += FLOAT.size
+            elif tag == b'i':
+                values.append(INT.unpack_from(data, offset)[0])
+                offset += INT.size
+            elif tag == b'h':
+                values.append(LONG.unpack_from(data, offset)[0])
+                offset += LONG.size
+            elif tag == b's':
+                (length,) = LENGTH.unpack_from(data, offset)
+                offset += LENGTH.size
+                values.append(data[offset:offset + length])
+                offset += length
+            elif tag in (b'T', b'F'):
+                values.append(tag == b'T')
+            else:
+                raise ValueError('Unknown value type {!r} at offset {}'.format(tag, offset - 1))
+        yield t / 1e6, addresses[address_id], values
+
+
+class CaptureSink:
+    """Local UDP endpoint standing in for STK_input_server: stores the commands
+    received, with their arrival time."""
+
+    def __init__(self, host='127.0.0.1'):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, 0))
+        self.address = self.sock.getsockname()
+        self.received = []  # (monotonic time, command)
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            data = self.sock.recv(65535)
+            now = time.monotonic()
+            if data == END_MARKER:
+                self.done.set()
+                return
+            data = data.partition(TRACE_SEP)[0]
+            for command in data.split(BATCH_SEP):
+                self.received.append((now, command))
+
+    def finish(self, client_socket, timeout=5.0):
+        """Wait until every datagram sent from client_socket before this call is received."""
+        client_socket.sendto(END_MARKER, self.address)
+        self.done.wait(timeout)
+        self.sock.close()
+
+    def commands(self):
+        return [command for _, command in self.received]
+
+
+def replay(path, mode='pad', speed=None, batch=False):
+    """Replay a log into a new Controller bound with `mode`, return the commands it sent.
+
+    speed=None replays at max speed on the recorded clock (deterministic), a
+    number replays in real time scaled by that factor.
+    """
+    sink = CaptureSink()
+    controller = Controller(sink.address, start_loop=speed is not None, batch=batch)
+    osc_server = OSCServer(controller, port=None)
+    osc_server.bind_callbacks(mode)
+
+    # Messages the mode does not use are skipped instead of being dumped
+    messages = [m for m in read_log(path) if m[1] in osc_server.handlers]
+
+    if speed is None:
+        # The gestures are recognized on the recorded clock too
+        recorded = [0.0]
+        controller.clock = lambda: recorded[0]
+        next_edge = math.inf
+        for t, address, values in messages:
+            recorded[0] = t
+            # Edges the control loop would have sent before this message
+            while next_edge <= t:
+                next_edge = controller.update_control(next_edge)
+                controller.flush()
+            osc_server.dispatch(address, *values)
+            next_edge = controller.update_control(t)
+            controller.flush()
+        # Let the last held controls go through their edges for one more PWM
+        # period, then release them: a control left partly deflected would
+        # otherwise send edges forever
+        end = (messages[-1][0] if messages else 0.0) + PWM_PERIOD
+        while next_edge <= end:
+            next_edge = controller.update_control(next_edge)
+            controller.flush()
+        recorded[0] = end
+        controller.release_all()
+    else:
+        start = time.monotonic()
+        for t, address, values in messages:
+            delay = start + t / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            osc_server.dispatch(address, *values)
+
+    controller.stop_loop()
+    sink.finish(controller.client_socket)
+    controller.stop()
+    return sink.commands()
+
+
+def compare(path):
+    """Replay the same log in every mode and print the command streams side by side."""
+    streams = {mode: replay(path, mode) for mode in MODES}
+    print('  '.join('{:<16}'.format('{} ({})'.format(mode, len(s))) for mode, s in streams.items()))
+    for i in range(max(len(s) for s in streams.values())):
+        print('  '.join('{:<16}'.format(s[i].decode('utf8') if i < len(s) else '')
+                        for s in streams.values()))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('replay', 'compare'):
+        print(__doc__)
+        sys.exit(1)
+    if sys.argv[1] == 'compare':
+        compare(sys.argv[2])
+    else:
+        mode = sys.argv[3] if len(sys.argv) > 3 else 'pad'
+        speed = sys.argv[4] if len(sys.argv) > 4 else 'max'
+        commands = replay(sys.argv[2], mode, None if speed == 'max' else float(speed))
+        for command in commands:
+            print(command.decode('utf8'))
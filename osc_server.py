@@ -1,44 +1,184 @@
+import threading
 from oscpy.server import OSCThreadServer
 from controller import Controller
+from latency import now_ns
+import log
+
+log_unbound = log.site(log.INFO, rate=20)
+log_profile = log.site(log.INFO)
+
+PROFILE_ADDRESS = b'/stk/profile'  # OSC message switching the profile: /stk/profile <name>
+
+# Input modes: OSC address -> name of the Controller callback handling it
+MODES = {
+    # This section is for controlling the game with the pad
+    'pad': [
+        (b'/multisense/pad/x', 'callback_x'),
+        (b'/multisense/pad/y', 'callback_y'),
+        (b'/multisense/pad/touchUP', 'callback_touchUP'),
+    ],
+    # This section is for controlling the game with orientation
+    'orientation': [
+        (b'/multisense/orientation/yaw', 'callback_yaw'),
+        (b'/multisense/orientation/roll', 'callback_roll'),
+        (b'/multisense/orientation/pitch', 'callback_pitch'),
+    ],
+    # For Shaker mvt (and a flick of the phone for nitro)
+    'shaker': [
+        (b'/multisense/orientation/yaw', 'callback_yaw_shaker'),
+        (b'/multisense/orientation/pitch', 'callback_pitch_flick'),
+    ],
+    # For Continues mvt
+    'continuous': [
+        (b'/multisense/pad/x', 'callback_x_continuous'),
+        (b'/multisense/pad/y', 'callback_y_continuous'),
+        (b'/multisense/pad/touchUP', 'callback_touchUP_continuous'),
+    ],
+    # Hand directions from the Leap Motion (handtracking.cs), analog controls
+    'hands': [
+        (b'/hand/left/direction', 'callback_hand_left'),
+        (b'/hand/right/direction', 'callback_hand_right'),
+    ],
+}
+
+# Callbacks that only depend on the latest value of their input: with a
+# coalescing Controller, their addresses go through its slot table (see
+# controller.LatestSlots). Events (touch, double tap) and the gestures, which
+# look at successive samples, always get every message.
+COALESCED = {'callback_x', 'callback_y', 'callback_yaw', 'callback_roll', 'callback_pitch',
+             'callback_x_continuous', 'callback_y_continuous'}
+
+
+def format_message(address, values):
+    return u'{}: {}'.format(
+        address.decode('utf8'),
+        ', '.join(
+            '{}'.format(
+                v.decode('utf8') if isinstance(v, bytes) else v
+            )
+            for v in values if values
+        )
+    )
+
 
 class OSCServer:
-    def __init__(self, controller, host='127.0.0.1', port=8000):
-        self.osc = OSCThreadServer(default_handler=self.dump)
-        self.sock = self.osc.listen(address=host, port=port, default=True)
+    def __init__(self, controller, host='127.0.0.1', port=8000, recorder=None):
+        """port=None creates the server without socket: messages are then only
+        delivered through dispatch (used to replay recorded sessions)."""
         self.controller = controller
+        self.recorder = recorder  # Optional osc_replay.OSCRecorder, gets every message received
+        self.handlers = {}  # OSC address -> callback
+        # Profiles (see profiles.py): their compiled handler tables, and the
+        # name of the active one, whose table is self.handlers
+        self.profiles = {}
+        self.tables = {}
+        self.profile = None
+        # Held while a message is handled and while the profile changes, so
+        # that no callback of the old profile runs after the switch
+        self.lock = threading.RLock()
+        self.osc = None
+        if port is not None:
+            # Every message goes through dispatch, which looks the address up in self.handlers
+            self.osc = OSCThreadServer(default_handler=self.dispatch)
+            self.sock = self.osc.listen(address=host, port=port, default=True)
+
+    def bind_callbacks(self, mode='pad'):
+        """Bind the OSC addresses of one of the MODES to the controller callbacks."""
+        for address, name in MODES[mode]:
+            self.bind(address, getattr(self.controller, name), coalesce=name in COALESCED)
+
+    def bind(self, address, callback, coalesce=False):
+        """Bind an OSC address to a callback, stamping messages when the controller traces latency.
+
+        With coalesce, and a Controller created with coalesce=True, only the
+        latest values are kept and the callback is called by the control loop
+        (the callback stamp is then taken there, the receive stamp is still
+        taken on reception, see dispatch).
+        """
+        self.handlers[address] = self.handler(callback, coalesce)
 
-    def bind_callbacks(self):
+    def handler(self, callback, coalesce=False):
+        """The callback as bound: traced and/or coalesced (see bind)."""
+        tracer = self.controller.tracer
+        if tracer is not None:
+            callback = self.traced(callback, tracer)
+        if coalesce and self.controller.slots is not None:
+            callback = self.controller.slots.add(callback)
+        return callback
 
-        # # This section is for controlling the game with the pad
-        self.osc.bind(b'/multisense/pad/x', self.controller.callback_x)
-        self.osc.bind(b'/multisense/pad/y', self.controller.callback_y)
-        self.osc.bind(b'/multisense/pad/touchUP', self.controller.callback_touchUP)
+    def compile(self, profile):
+        """Address -> handler table of a profile (see profiles.Profile)."""
+        table = {address: self.handler(getattr(self.controller, name), coalesce=name in COALESCED)
+                 for address, name in profile.bindings}
+        table[PROFILE_ADDRESS] = self.on_profile_message
+        return table
 
+    def use_profiles(self, profiles, default):
+        """Compile all the profiles and activate the current one if it is still
+        there, default otherwise (also used to reload the profiles file)."""
+        with self.lock:
+            if self.controller.slots is not None:
+                # The coalescing slots of the old tables are not needed anymore
+                self.controller.slots.clear()
+            self.tables = {name: self.compile(profile) for name, profile in profiles.items()}
+            self.profiles = profiles
+            self.switch(self.profile if self.profile in profiles else default)
 
-        # # This section is for controlling the game with orientation and firing with double tap
-        # self.osc.bind(b'/multisense/orientation/yaw', self.controller.callback_yaw)
-        # self.osc.bind(b'/multisense/orientation/roll', self.controller.callback_roll)
-        # self.osc.bind(b'/multisense/orientation/pitch', self.controller.callback_pitch)
+    def switch(self, name):
+        """Activate a profile: release the keys held, then swap the thresholds
+        and the handler table at once. Messages are not dropped: they wait for
+        the lock, and are handled by the new profile."""
+        with self.lock:
+            if self.controller.slots is not None:
+                self.controller.slots.discard()
+            self.controller.release_all()
+            self.controller.set_params(self.profiles[name].parameters())
+            self.handlers = self.tables[name]
+            self.profile = name
+        log_profile('Profile: {}', name)
 
-        ##For Shaker mvt
-        # self.osc.bind(b'/multisense/orientation/yaw', self.controller.callback_yaw_shaker)
+    def on_profile_message(self, *values):
+        name = values[0].decode('utf8') if values and isinstance(values[0], bytes) else str(values[0] if values else '')
+        if name in self.profiles:
+            self.switch(name)
+        else:
+            log_profile('Unknown profile: {}', name)
 
-        ##For Continues mvt
-        # self.osc.bind(b'/multisense/pad/x', self.controller.callback_x_continuous)
-        # self.osc.bind(b'/multisense/pad/y', self.controller.callback_y_continuous)
-        # self.osc.bind(b'/multisense/pad/touchUP', self.controller.callback_touchUP_continuous)
+    @staticmethod
+    def traced(callback, tracer):
+        def handler(*values):
+            tracer.called()
+            callback(*values)
+        return handler
+
+    def dispatch(self, address, *values):
+        """Deliver one OSC message to the callback bound to its address."""
+        tracer = self.controller.tracer
+        self.deliver(address, values, None if tracer is None else now_ns())
+
+    def deliver(self, address, values, received_ns=None):
+        """dispatch, for a message received at received_ns (now_ns, when the
+        controller traces latency), possibly by another thread (players.py)."""
+        if self.recorder is not None:
+            self.recorder.record(address, values)
+        with self.lock:
+            handler = self.handlers.get(address)
+            if handler is None:
+                self.dump(address, *values)
+            else:
+                # Only the messages of traced callbacks are stamped (the stamp
+                # itself was taken on reception, before the lookup)
+                if received_ns is not None and handler != self.on_profile_message:
+                    self.controller.tracer.received(received_ns)
+                handler(*values)
 
     def dump(self, address, *values):
-        """Default handler for unbound OSC messages."""
-        print(u'{}: {}'.format(
-            address.decode('utf8'),
-            ', '.join(
-                '{}'.format(
-                    v.decode('utf8') if isinstance(v, bytes) else v
-                )
-                for v in values if values
-            )
-        ))
+        """Default handler for unbound OSC messages (formatted by the log writer)."""
+        if log_unbound.enabled:
+            log_unbound(format_message, address, values)
 
     def stop(self):
-        self.osc.stop()
+        if self.osc is not None:
+            self.osc.stop()
+        if self.recorder is not None:
+            self.recorder.close()
@@ -0,0 +1,251 @@
+"""Several phones or sensors, one player each: local split-screen races.
+
+usage:
+  python players.py PLAYERS [--processes] [--port PORT] [-m MODE] [-p FILE] [-b] [-c]
+
+Each player has its own Controller (thresholds, gesture state, held keys,
+control loop), which sends to its own port of the STK input server, started
+with the same number of players (`STK_input_server.py -n PLAYERS`): port
+6006 for player 1, 6007 for player 2... The server types the keys of each
+player (STK_input_server.PLAYER_KEYS).
+
+Threads (default): all the devices send to the same OSC port (8000). A
+PlayerRouter receives them on one socket and hands each message to the worker
+thread of its player, which runs its OSCServer and Controller callbacks: a
+slow player does not delay the others, and the receiving thread only parses
+the messages. The player of a message is:
+  - given by an address prefix: /p2/multisense/pad/x is /multisense/pad/x
+    for player 2 (for several devices on the same host, or a fixed mapping);
+  - otherwise its source IP: each new device takes the next free player.
+
+Processes (--processes): player N is a process of its own, with its OSC
+server on port 8000 + N - 1, where its device sends. The players then run
+in parallel on the cores instead of sharing one interpreter.
+
+-m, -p, -b and -c are those of mainTP1.py, for every player; the OSC message
+/stk/profile <name> switches the profile of the player that sends it.
+"""
+import multiprocessing
+import queue
+import re
+import socket
+import struct
+import sys
+import threading
+
+from oscpy.parser import read_packet
+
+import log
+from controller import Controller
+from latency import now_ns
+from osc_server import OSCServer
+from profiles import builtin_profiles, load_profiles, ProfileWatcher
+
+STK_ADDRESS = ('localhost', 6006)  # Port of player 1, the next players use the following ones
+OSC_HOST = '0.0.0.0'
+OSC_PORT = 8000
+QUEUE_SIZE = 1024  # Messages waiting for the worker of a player; the newest are dropped beyond
+RECV_SIZE = 65536
+PREFIX = re.compile(br'/p(\d+)(/.*)', re.S)
+
+log_player = log.site(log.INFO)
+log_dropped = log.site(log.WARNING, rate=1)
+log_invalid = log.site(log.WARNING, rate=1)
+
+
+class Player:
+    """Controller and OSCServer of one player, fed by a worker thread.
+
+    The OSCServer has no socket: the messages come from the PlayerRouter,
+    through submit.
+    """
+
+    def __init__(self, index, stk_address=STK_ADDRESS, profiles=None, default='pad',
+                 batch=False, trace=False, coalesce=False):
+        self.index = index
+        self.controller = Controller((stk_address[0], stk_address[1] + index),
+                                     batch=batch, trace=trace, coalesce=coalesce)
+        self.osc_server = OSCServer(self.controller, port=None)
+        self.osc_server.use_profiles(profiles or builtin_profiles(), default)
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.received = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, address, values):
+        self.received += 1
+        # With latency tracing, the receive stamp is taken here, by the router
+        received_ns = None if self.controller.tracer is None else now_ns()
+        try:
+            self.queue.put_nowait((address, values, received_ns))
+        except queue.Full:
+            self.dropped += 1
+            log_dropped('Player {}: queue full, {} messages dropped', self.index + 1, self.dropped)
+
+    def run(self):
+        get = self.queue.get
+        deliver = self.osc_server.deliver
+        while True:
+            message = get()
+            if message is None:
+                break
+            deliver(*message)
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.osc_server.stop()
+        self.controller.stop()
+
+    def report(self):
+        line = 'Player {}: {} messages, {} dropped'.format(self.index + 1, self.received, self.dropped)
+        if self.controller.slots is not None:
+            line += ', ' + self.controller.slots.report()
+        return line
+
+
+class PlayerRouter:
+    """One UDP socket for all the devices, each message going to its Player
+    (see the module docstring for the routing)."""
+
+    def __init__(self, players, host=OSC_HOST, port=OSC_PORT):
+        self.players = players
+        self.sources = {}  # Source IP -> Player
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.settimeout(0.5)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def player_of(self, source):
+        """Player of a device without prefix: the next free one for a new source."""
+        player = self.sources.get(source)
+        if player is None:
+            taken = set(self.sources.values())
+            free = [p for p in self.players if p not in taken]
+            if not free:
+                return None
+            player = self.sources[source] = free[0]
+            log_player('Player {}: {}', player.index + 1, source)
+        return player
+
+    def route(self, data, source):
+        for address, tags, values, size in read_packet(data):
+            match = PREFIX.match(address)
+            if match:
+                index = int(match.group(1)) - 1
+                if not 0 <= index < len(self.players):
+                    continue
+                self.players[index].submit(match.group(2), values)
+            else:
+                player = self.player_of(source)
+                if player is not None:
+                    player.submit(address, values)
+
+    def run(self):
+        recvfrom = self.sock.recvfrom
+        while self.running:
+            try:
+                data, (source, port) = recvfrom(RECV_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                self.route(data, source)
+            except (ValueError, IndexError, struct.error) as error:
+                # One bad datagram must not stop the router: skip it
+                log_invalid('Invalid OSC packet from {}: {!r}', source, error)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+
+def run_player_process(index, port, stopped, profiles_path, default, options):
+    """Player `index` in its own process, with its own OSC server on `port`."""
+    if profiles_path:
+        profiles, file_default = load_profiles(profiles_path)
+        default = default or file_default
+    else:
+        profiles = builtin_profiles()
+    controller = Controller((STK_ADDRESS[0], STK_ADDRESS[1] + index), **options)
+    osc_server = OSCServer(controller, host=OSC_HOST, port=port)
+    osc_server.use_profiles(profiles, default or 'pad')
+    watcher = ProfileWatcher(profiles_path, osc_server) if profiles_path else None
+    print('Player {}: OSC port {}, STK port {}'.format(index + 1, port, STK_ADDRESS[1] + index))
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        osc_server.stop()
+        controller.stop()
+        if controller.slots is not None:
+            print('Player {}: {}'.format(index + 1, controller.slots.report()))
+
+
+def main():
+    args = sys.argv[1:]
+    if not args or not args[0].isdigit():
+        print(__doc__)
+        sys.exit(1)
+    count = int(args[0])
+    port = int(args[args.index('--port') + 1]) if '--port' in args else OSC_PORT
+    profiles_path = args[args.index('-p') + 1] if '-p' in args else None
+    default = args[args.index('-m') + 1] if '-m' in args else None
+    options = {'batch': '-b' in args, 'coalesce': '-c' in args}
+    if default is not None:
+        names = load_profiles(profiles_path)[0] if profiles_path else builtin_profiles()
+        if default not in names:
+            print('Unknown profile {} (one of {})'.format(default, ', '.join(names)))
+            sys.exit(1)
+
+    if '--processes' in args:
+        stopped = multiprocessing.Event()
+        processes = [multiprocessing.Process(
+            target=run_player_process,
+            args=(index, port + index, stopped, profiles_path, default, options))
+            for index in range(count)]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            stopped.set()
+            for process in processes:
+                process.join()
+        return
+
+    if profiles_path:
+        profiles, file_default = load_profiles(profiles_path)
+        default = default or file_default
+    else:
+        profiles = builtin_profiles()
+    players = [Player(index, profiles=profiles, default=default or 'pad', **options)
+               for index in range(count)]
+    router = PlayerRouter(players, port=port)
+    watchers = [ProfileWatcher(profiles_path, player.osc_server) for player in players] if profiles_path else []
+    print('{} players on OSC port {}, STK ports {} to {}'.format(
+        count, port, STK_ADDRESS[1], STK_ADDRESS[1] + count - 1))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for watcher in watchers:
+            watcher.stop()
+        router.stop()
+        for player in players:
+            player.stop()
+            print(player.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+######################################################################################
+# Shows the face tracking preview published in shared memory by                      #
+#   python face_tracking.py --headless --shm NAME                                    #
+#                                                                                    #
+# usage: python preview_viewer.py NAME                                               #
+# Hit ESC key to quit.                                                               #
+######################################################################################
+import sys
+
+import cv2
+import numpy as np
+
+from frame_pipeline import SharedFrameSlot
+
+
+def main():
+    name = sys.argv[1] if len(sys.argv) > 1 else "face_tracking"
+    slot = SharedFrameSlot(name)
+    frame = np.empty(slot.shape, np.uint8)
+    seq = 0
+    while True:
+        new_seq = slot.read(frame, seq)
+        if new_seq != seq:
+            seq = new_seq
+            cv2.imshow(name, frame)
+        if cv2.waitKey(20) & 0xff == 27:
+            break
+    slot.close()
+    cv2.destroyAllWindows()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Input mapping profiles: bindings and thresholds, switched without restarting.
+
+A profile binds OSC addresses to Controller callbacks (like osc_server.MODES)
+and sets the thresholds of the callbacks (controller.PARAMETERS). Profiles are
+defined in a JSON file:
+
+    {
+      "default": "pad",
+      "profiles": {
+        "pad": {"mode": "pad"},
+        "tilt": {"mode": "orientation",
+                 "params": {"STEER_ANGLE_THRES": 12, "ACCEL_ANGLE_OFFSET": -40}},
+        "custom": {"bindings": {"/multisense/pad/x": "callback_x"}}
+      }
+    }
+
+"mode" takes the bindings of one of the MODES, "bindings" adds to (or replaces)
+them. OSCServer.use_profiles compiles every profile into its address -> handler
+table once; then the profile is switched by sending the OSC message
+`/stk/profile <name>` (see osc_server.PROFILE_ADDRESS), or by editing the file
+when it is watched (ProfileWatcher), which reloads it.
+"""
+import json
+import os
+import threading
+
+import log
+from controller import Controller, Parameters
+from osc_server import MODES
+
+log_watch = log.site(log.WARNING)
+
+
+class Profile:
+    """Bindings [(OSC address, Controller callback name)] and thresholds of one profile."""
+
+    def __init__(self, name, bindings, params=None):
+        self.name = name
+        self.bindings = list(bindings)
+        self.params = dict(params or {})
+        for address, callback in self.bindings:
+            if not callable(getattr(Controller, callback, None)):
+                raise ValueError('Profile {}: no Controller callback {}'.format(name, callback))
+        Parameters(**self.params)  # Raises ValueError for unknown parameters
+
+    def parameters(self):
+        return Parameters(**self.params)
+
+
+def builtin_profiles():
+    """One profile per mode of MODES, with the default thresholds."""
+    return {mode: Profile(mode, bindings) for mode, bindings in MODES.items()}
+
+
+JSON_TYPES = {dict: 'an object', str: 'a string', (int, float): 'a number'}
+
+
+def expect(value, kind, what):
+    """value, if it is of one of the JSON_TYPES kind, ValueError otherwise."""
+    if isinstance(value, bool) or not isinstance(value, kind):
+        raise ValueError('{}: {!r} is not {}'.format(what, value, JSON_TYPES[kind]))
+    return value
+
+
+def load_profiles(path):
+    """Return ({name: Profile}, default profile name) from a JSON profiles file.
+
+    Raises ValueError (or OSError) when the file is invalid, so that a bad
+    edit of a watched file leaves the current profiles in place.
+    """
+    with open(path) as f:
+        config = expect(json.load(f), dict, 'profiles file')
+    if 'profiles' not in config:
+        raise ValueError('No "profiles" in {}'.format(path))
+    profiles = {}
+    for name, definition in expect(config['profiles'], dict, 'profiles').items():
+        expect(definition, dict, 'Profile {}'.format(name))
+        bindings = {}
+        if 'mode' in definition:
+            mode = expect(definition['mode'], str, 'Profile {}: mode'.format(name))
+            if mode not in MODES:
+                raise ValueError('Profile {}: unknown mode {}'.format(name, mode))
+            bindings.update(MODES[mode])
+        for address, callback in expect(definition.get('bindings', {}), dict,
+                                        'Profile {}: bindings'.format(name)).items():
+            expect(callback, str, 'Profile {}: callback of {}'.format(name, address))
+            bindings[address.encode('utf8')] = callback
+        params = expect(definition.get('params', {}), dict, 'Profile {}: params'.format(name))
+        for parameter, value in params.items():
+            expect(value, (int, float), 'Profile {}: {}'.format(name, parameter))
+        profiles[name] = Profile(name, bindings.items(), params)
+    if not profiles:
+        raise ValueError('No profile in {}'.format(path))
+    default = expect(config.get('default', next(iter(profiles))), str, 'default')
+    if default not in profiles:
+        raise ValueError('Unknown default profile {}'.format(default))
+    return profiles, default
+
+
+class ProfileWatcher:
+    """Reload a profiles file into an OSCServer when it changes (polled every `interval` seconds)."""
+
+    def __init__(self, path, osc_server, interval=1.0):
+        self.path = path
+        self.osc_server = osc_server
+        self.interval = interval
+        self.mtime = self.modified()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def modified(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            mtime = self.modified()
+            if mtime == self.mtime:
+                continue
+            self.mtime = mtime
+            try:
+                profiles, default = load_profiles(self.path)
+            except (OSError, ValueError) as error:
+                log_watch('Profiles not reloaded from {}: {!r}', self.path, error)
+                continue
+            self.osc_server.use_profiles(profiles, default)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
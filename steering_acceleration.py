@@ -1,4 +1,5 @@
 from enum import Enum
+import math
 
 class STEER(Enum):
     LEFT = 1
@@ -10,3 +11,116 @@ class ACCEL(Enum):
     UP = 1
     NEUTRAL = 2
     DOWN = 3
+
+
+# Edges, used as index in the command tables below
+PRESS = 0
+RELEASE = 1
+
+# (direction, edge) -> command sent to the STK input server
+STEER_COMMANDS = {
+    STEER.LEFT: (b'P_LEFT', b'R_LEFT'),
+    STEER.RIGHT: (b'P_RIGHT', b'R_RIGHT'),
+}
+
+ACCEL_COMMANDS = {
+    ACCEL.UP: (b'P_UP', b'R_UP'),
+    ACCEL.DOWN: (b'P_DOWN', b'R_DOWN'),
+}
+
+
+class Axis:
+    """State of one control (steering or acceleration) and the edges it sends.
+
+    `direction` and `value` are the latest input, `pressed` is the direction whose
+    key is currently down (None when released) and `timer` the monotonic time of
+    the next press/release edge of the analog (PWM) mode.
+    """
+    __slots__ = ('commands', 'neutral', 'send', 'period',
+                 'direction', 'value', 'pressed', 'timer')
+
+    def __init__(self, commands, neutral, send, period):
+        self.commands = commands
+        self.neutral = neutral
+        self.send = send
+        self.period = period
+        self.direction = neutral
+        self.value = 0.0
+        self.pressed = None
+        self.timer = 0.0
+
+    def set(self, direction):
+        """Discrete mode: press or release so that `direction` is the key held.
+
+        The input becomes a full deflection in `direction`, so that tick (run
+        by the control loop) holds the key instead of releasing it.
+        """
+        self.direction = direction
+        self.value = 0.0 if direction is self.neutral else 1.0
+        pressed = self.pressed
+        if pressed is direction or (pressed is None and direction is self.neutral):
+            return
+        if pressed is not None:
+            self.send(self.commands[pressed][RELEASE])
+            self.pressed = None
+        if direction is not self.neutral:
+            self.send(self.commands[direction][PRESS])
+            self.pressed = direction
+
+    def release(self):
+        """Release the key held, if any."""
+        self.direction = self.neutral
+        self.value = 0.0
+        if self.pressed is not None:
+            self.send(self.commands[self.pressed][RELEASE])
+            self.pressed = None
+
+    def tick(self, now):
+        """Analog mode: press for value * period, release for the rest of the period.
+
+        Edges are scheduled on the monotonic clock from the previous edge, so the
+        duty cycle is not rounded to a loop tick and does not drift. Returns the
+        time of the next edge, or math.inf when nothing has to happen until the
+        input changes.
+        """
+        direction = self.direction
+        value = self.value
+        pressed = self.pressed
+
+        if value == 0.0 or direction is self.neutral:
+            # Ensure the control is released
+            if pressed is not None:
+                self.send(self.commands[pressed][RELEASE])
+                self.pressed = None
+            self.timer = 0.0
+            return math.inf
+
+        timer = self.timer
+        if pressed is not None and pressed is not direction:
+            # Direction flipped while pressed: release the old key, press the new one
+            self.send(self.commands[pressed][RELEASE])
+            self.send(self.commands[direction][PRESS])
+            self.pressed = direction
+            self.timer = now + value * self.period
+            return self.timer
+
+        if now < timer:
+            return timer
+
+        if pressed is not None:
+            t2 = (1.0 - value) * self.period
+            if t2 <= 0.0:
+                # Full deflection: hold the key until the value changes
+                self.timer = 0.0
+                return math.inf
+            self.send(self.commands[pressed][RELEASE])
+            self.pressed = None
+            # Schedule from the previous edge, unless more than a phase behind
+            timer = max(timer + t2, now) if timer else now + t2
+        else:
+            self.send(self.commands[direction][PRESS])
+            self.pressed = direction
+            t1 = value * self.period
+            timer = max(timer + t1, now) if timer else now + t1
+        self.timer = timer
+        return timer
@@ -0,0 +1,39 @@
+"""Wire format between the controllers and STK_input_server.py.
+
+Each UDP datagram carries either a single command, as it always did
+(b'P_LEFT', optionally followed by OSC-style commas), or, in batch mode,
+several commands separated by BATCH_SEP (b'R_LEFT\\nR_UP'), in the order they
+must be applied.
+
+When latency tracing is enabled (see latency.py), the sender appends TRACE_SEP
+and its comma-separated nanosecond stamps to the datagram:
+b'P_LEFT#<recv>,<callback>,<send>'.
+"""
+
+BATCH_SEP = b'\n'
+TRACE_SEP = b'#'
+TRACE_STAMPS = 3  # recv, callback, send
+
+
+def encode_batch(commands):
+    """Join a list of commands into the payload of one datagram."""
+    return BATCH_SEP.join(commands)
+
+
+def add_trace(data, stamps):
+    """Append the trace stamps to a datagram payload (no-op if stamps is None)."""
+    if stamps is None:
+        return data
+    return data + TRACE_SEP + b','.join(b'%d' % t for t in stamps)
+
+
+def split_trace(data):
+    """Split a traced datagram into its payload and tuple of stamps.
+
+    Raises ValueError unless there are exactly TRACE_STAMPS integer stamps.
+    """
+    data, _, stamps = data.partition(TRACE_SEP)
+    stamps = tuple(int(t) for t in stamps.split(b','))
+    if len(stamps) != TRACE_STAMPS:
+        raise ValueError('{} trace stamps instead of {}'.format(len(stamps), TRACE_STAMPS))
+    return data, stamps
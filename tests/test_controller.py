@@ -0,0 +1,123 @@
+"""Tests of the Controller: touch release after a burst with coalescing (-c),
+latency stamps (-t).
+
+run: python -m pytest tests   (or python -m unittest discover tests)
+"""
+import os
+import socket
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from controller import Controller
+from osc_server import OSCServer
+from stk_protocol import TRACE_SEP, split_trace
+
+
+class CoalescedTouchUpTest(unittest.TestCase):
+
+    def setUp(self):
+        # Stands for the STK input server: receives the commands sent
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(0.2)
+        self.controller = Controller(self.server.getsockname(), coalesce=True)
+        self.osc_server = OSCServer(self.controller, port=None)
+
+    def tearDown(self):
+        self.controller.stop()
+        self.server.close()
+
+    def commands(self):
+        commands = []
+        try:
+            while True:
+                commands.append(self.server.recv(1024))
+        except socket.timeout:
+            return commands
+
+    def burst_then_touch_up(self, mode, address, value):
+        """Samples at about 500 Hz, then the release right after the last one."""
+        self.osc_server.bind_callbacks(mode)
+        for _ in range(50):
+            self.osc_server.dispatch(address, value)
+            time.sleep(0.002)
+        self.osc_server.dispatch(b'/multisense/pad/touchUP', 1)
+        time.sleep(0.1)
+        self.controller.stop_loop()
+        return self.commands()
+
+    def assertReleased(self, commands):
+        held = set()
+        for command in commands:
+            key = command[2:]
+            if command.startswith(b'P_'):
+                held.add(key)
+            else:
+                held.discard(key)
+        self.assertEqual(held, set(), 'keys held at the end: {}'.format(commands[-6:]))
+        self.assertIsNone(self.controller.steering.pressed)
+        self.assertIsNone(self.controller.accel.pressed)
+
+    def test_pad(self):
+        commands = self.burst_then_touch_up('pad', b'/multisense/pad/x', 0.8)
+        self.assertIn(b'P_RIGHT', commands)
+        self.assertEqual(self.controller.steering.value, 0.0)
+        self.assertReleased(commands)
+
+    def test_continuous(self):
+        commands = self.burst_then_touch_up('continuous', b'/multisense/pad/x', 0.8)
+        self.assertIn(b'P_UP', commands)
+        self.assertReleased(commands)
+
+
+class TraceStampsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(0.2)
+
+    def tearDown(self):
+        self.server.close()
+
+    def traced(self, coalesce):
+        """Stamps of the commands sent for pad messages mixed with unbound ones."""
+        controller = Controller(self.server.getsockname(), trace=True, coalesce=coalesce)
+        osc_server = OSCServer(controller, port=None)
+        osc_server.bind_callbacks('pad')
+        for x in (0.6, 0.9, -0.7):
+            osc_server.dispatch(b'/multisense/pad/x', x)
+            time.sleep(0.02)
+            # Unbound in pad mode: must not give its receive stamp to the PWM edges
+            osc_server.dispatch(b'/multisense/orientation/pitch', 10.0)
+            time.sleep(0.03)
+        osc_server.dispatch(b'/multisense/pad/touchUP', 1)
+        time.sleep(0.05)
+        controller.stop()
+        stamps = []
+        try:
+            while True:
+                data = self.server.recv(1024)
+                if TRACE_SEP in data:
+                    stamps.append(split_trace(data)[1])
+        except socket.timeout:
+            return stamps
+
+    def assertOrdered(self, stamps):
+        self.assertTrue(stamps)
+        for recv, callback, send in stamps:
+            self.assertLessEqual(recv, callback)
+            self.assertLessEqual(callback, send)
+
+    def test_stamps_ordered(self):
+        self.assertOrdered(self.traced(coalesce=False))
+
+    def test_stamps_ordered_coalesced(self):
+        self.assertOrdered(self.traced(coalesce=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""Regression tests of the max-speed replay (osc_replay.py).
+
+run: python -m pytest tests   (or python -m unittest discover tests)
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from osc_replay import OSCRecorder, replay
+
+
+def record(messages):
+    """Log of (delay in seconds before the message, address, values), returns its path."""
+    handle, path = tempfile.mkstemp(suffix='.osclog')
+    os.close(handle)
+    recorder = OSCRecorder(path)
+    for delay, address, values in messages:
+        time.sleep(delay)
+        recorder.record(address, values)
+    recorder.close()
+    return path
+
+
+def replay_within(test, path, mode, timeout=5.0):
+    """Commands of a max-speed replay, failing the test if it does not end in time."""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(replay(path, mode)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    test.assertFalse(thread.is_alive(), 'replay did not end within {} s'.format(timeout))
+    return result[0]
+
+
+class MaxSpeedReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.paths = []
+
+    def tearDown(self):
+        for path in self.paths:
+            os.unlink(path)
+
+    def log(self, messages):
+        path = record(messages)
+        self.paths.append(path)
+        return path
+
+    def test_ends_with_a_control_partly_deflected(self):
+        # No touchUP: the steering is left in PWM at the end of the log
+        path = self.log([(0.0, b'/multisense/pad/x', [0.6])])
+        commands = replay_within(self, path, 'pad')
+        self.assertEqual(commands[0], b'P_RIGHT')
+        self.assertEqual(commands[-1], b'R_RIGHT')
+        self.assertLess(len(commands), 10)
+
+    def test_releases_a_control_held_at_the_end(self):
+        path = self.log([(0.0, b'/multisense/pad/x', [1.0])])
+        self.assertEqual(replay_within(self, path, 'pad'), [b'P_RIGHT', b'R_RIGHT'])
+
+    def test_touch_up_releases(self):
+        path = self.log([(0.0, b'/multisense/pad/x', [1.0]),
+                         (0.05, b'/multisense/pad/touchUP', [1])])
+        self.assertEqual(replay_within(self, path, 'pad'), [b'P_RIGHT', b'R_RIGHT'])
+
+    def test_deterministic(self):
+        path = self.log([(0.0, b'/multisense/pad/x', [0.6]),
+                         (0.03, b'/multisense/pad/y', [-0.5]),
+                         (0.05, b'/multisense/pad/touchUP', [1])])
+        self.assertEqual(replay_within(self, path, 'pad'), replay_within(self, path, 'pad'))
+
+
+if __name__ == '__main__':
+    unittest.main()